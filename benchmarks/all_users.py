@@ -0,0 +1,140 @@
+#!/usr/bin/python
+'''
+Times --all-users over synthetic homes: reconcileAllUsers matching the Dock
+plists of N homes without a session, through PlistFileBackend, with several
+MaxWorkers settings, and writes the min, median and max seconds as JSON.
+
+Each run is timed cold, every Dock empty and no fingerprint saved, and then
+warm, with nothing left to change. The homes are folders under a temp folder
+handed out by a stand-in for pwd.getpwnam, all owned by the user running
+this, so it needs neither root nor a Mac. The dock-maintainer preferences
+are read from a MemoryBackend instead of CFPreferences.
+'''
+import argparse
+import os
+import plistlib
+import pwd
+import shutil
+import sys
+import tempfile
+from contextlib import contextmanager
+
+from helpers import Timer, loadScript, writeResults
+
+agent = loadScript("dock-maintainer")
+
+class Homes(object):
+    '''N homes with a config of apps apps each, under folder'''
+    def __init__(self, folder, count, apps):
+        self.folder = folder
+        self.configs = os.path.join(folder, "configs")
+        os.mkdir(self.configs)
+        paths = [os.path.join(folder, "Applications", "App %03d.app" % index)
+                 for index in range(apps)]
+        for thePath in paths:
+            os.makedirs(thePath)
+        self.users = {}
+        for index in range(count):
+            username = "student%04d" % index
+            home = os.path.join(folder, "Users", username)
+            os.makedirs(os.path.join(home, "Library", "Preferences"))
+            os.mkdir(os.path.join(home, "Documents"))
+            plistlib.writePlist({"Apps": paths, "Others": ["~/Documents"]},
+                                os.path.join(self.configs, username))
+            self.users[username] = pwd.struct_passwd(
+                (username, "*", os.getuid(), os.getgid(), "", home, "/bin/bash"))
+
+    def getpwnam(self, username):
+        '''stands in for pwd.getpwnam'''
+        if username not in self.users:
+            raise KeyError(username)
+        return self.users[username]
+
+    def forget(self):
+        '''empties every Dock and drops every fingerprint'''
+        for user in self.users.values():
+            plistlib.writePlist({"persistent-apps": [], "persistent-others": []},
+                                os.path.join(user.pw_dir, "Library", "Preferences",
+                                             agent.Dock._DOMAIN + ".plist"))
+            shutil.rmtree(os.path.join(user.pw_dir, "Library", "Application Support"), True)
+
+    def preferences(self, maxworkers):
+        '''returns the preferences managing every home'''
+        return agent.MemoryBackend({"com.github.wardsparadox.dock-maintainer": {
+            "Profiles": [{"ManagedUser": username} for username in sorted(self.users)],
+            "MaxWorkers": maxworkers}})
+
+@contextmanager
+def quiet():
+    '''sends what the workers print to /dev/null, keeping stdout for the results'''
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+def benchmark(homes, maxworkers, repeat):
+    '''returns the cold and warm seconds of repeat runs over homes'''
+    agent.FoundationBackend = lambda: homes.preferences(maxworkers)
+    timer = Timer()
+    for _ in range(repeat):
+        homes.forget()
+        for phase, result in (("cold", "changed"), ("warm", "unchanged")):
+            agent.METRICS.reset()
+            timer.time(phase, agent.reconcileAllUsers)
+            if agent.METRICS.counters.get(result) != len(homes.users):
+                raise AssertionError("%s run did not leave every home %s: %s"
+                                     % (phase, result, agent.METRICS.counters))
+    return timer.phases()
+
+def cpuCount():
+    '''returns the number of CPUs, which caps what more workers can gain'''
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times --all-users over synthetic homes and worker counts.")
+    parser.add_argument("--homes", default="10,100",
+                        help="comma separated numbers of homes")
+    parser.add_argument("--workers", default="1,2,4,8",
+                        help="comma separated MaxWorkers settings")
+    parser.add_argument("--apps", type=int, default=20,
+                        help="apps in every config")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per number of homes and workers")
+    parser.add_argument("--output", help="file to write the JSON results to, "
+                                         "instead of stdout")
+    args = parser.parse_args()
+    counts = [int(count) for count in args.homes.split(",")]
+    workers = [int(count) for count in args.workers.split(",")]
+    results = []
+    for count in counts:
+        folder = tempfile.mkdtemp(prefix="dock-maintainer-homes.")
+        try:
+            homes = Homes(folder, count, args.apps)
+            agent.pwd.getpwnam = homes.getpwnam
+            agent.guiSession = lambda uid: False
+            agent.CONFIG_PATH = homes.configs
+            for maxworkers in workers:
+                with quiet():
+                    phases = benchmark(homes, maxworkers, args.repeat)
+                results.append({"Homes": count, "MaxWorkers": maxworkers,
+                                "Phases": phases,
+                                "HomesPerSecond": dict(
+                                    (phase, round(count / summary["Median"], 1))
+                                    for phase, summary in phases.items())})
+        finally:
+            shutil.rmtree(folder, True)
+    writeResults("all_users", {"Homes": counts, "Workers": workers, "Apps": args.apps,
+                               "Repeat": args.repeat, "CPUs": cpuCount()},
+                 results, args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+'''
+Simulates a lab powering on: N updater clients sync one profile each against
+a local stand-in for the plist server, and the run reports the peak number of
+requests the server had in flight, the p50 and p99 time to sync and the bytes
+it served, as JSON.
+
+Each client waits out a random splay, as the Splay preference has the
+updater do, then calls syncProfile with a ConnectionPool of its own. The
+server takes service seconds per request and answers 503 with a Retry-After
+of retry-after seconds once capacity requests are in flight, which the pools
+back off from with their own jitter. The splay and every wait run on a clock
+sped up by timescale, so a minute of splay takes six seconds, and the times
+reported are in the simulated seconds. Much faster than that and the clients'
+own work, which is not sped up, looks as slow as the server.
+'''
+import BaseHTTPServer
+import SocketServer
+import argparse
+import hashlib
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from helpers import loadScript, writeResults
+
+updater = loadScript("dock-maintainer-updater")
+
+def docksetup(size):
+    '''returns a docksetup plist of size apps as a string'''
+    import plistlib
+    return plistlib.writePlistToString(
+        {"Apps": ["/Applications/App %03d.app" % index for index in range(size)],
+         "Others": ["/Applications", "~/Downloads"]})
+
+class _ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    # a whole lab connects at once
+    request_queue_size = 1024
+
+class FleetServer(object):
+    '''
+    A plist server on localhost that serves body at every path, holding
+    each request service seconds and turning requests away with 503 once
+    capacity are in flight. It keeps the peak of requests in flight and
+    counts requests, statuses and the body bytes it sent.
+    '''
+    def __init__(self, body, service, capacity, retry_after, timescale):
+        self.body = body
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        self.service = service
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.timescale = timescale
+        self.inflight = 0
+        self.peak = 0
+        self.statuses = {}
+        self.bytes = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server._answer(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = _ThreadingServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d" % self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _answer(self, handler):
+        with self._lock:
+            busy = self.capacity and self.inflight >= self.capacity
+            if not busy:
+                self.inflight += 1
+                self.peak = max(self.peak, self.inflight)
+        if busy:
+            self._send(handler, 503, {"Retry-After": str(self.retry_after)}, "")
+            return
+        try:
+            time.sleep(self.service * self.timescale)
+            if handler.headers.get("If-None-Match") == self.etag:
+                self._send(handler, 304, {"ETag": self.etag}, "")
+            else:
+                self._send(handler, 200, {"ETag": self.etag}, self.body)
+        finally:
+            with self._lock:
+                self.inflight -= 1
+
+    def _send(self, handler, status, headers, body):
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+        with self._lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.bytes += len(body)
+
+    def close(self):
+        '''stops the server'''
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+def percentile(values, percent):
+    '''returns the nearest-rank percentile of values to the millisecond,
+        None when empty'''
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[max(0, int(math.ceil(percent / 100.0 * len(ordered))) - 1)], 3)
+
+class Client(threading.Thread):
+    '''
+    One Mac of the lab: waits out its splay and syncs its profile into a
+    store of its own, recording the simulated seconds that took
+    '''
+    def __init__(self, index, server, folder, splay, timescale, retries, start):
+        threading.Thread.__init__(self, name="Client%d" % index)
+        self.daemon = True
+        self.random = random.Random(index)
+        self.server = server
+        self.path = os.path.join(folder, "client%d" % index)
+        os.makedirs(os.path.join(self.path, updater.BLOBS))
+        self.splay = splay
+        self.timescale = timescale
+        self.pool = updater.ConnectionPool(retries, self.sleep, self.random.random)
+        self.start_event = start
+        self.result = None
+        self.seconds = None
+
+    def sleep(self, seconds):
+        '''sleeps seconds of simulated time'''
+        time.sleep(seconds * self.timescale)
+
+    def run(self):
+        self.start_event.wait()
+        started = time.time()
+        try:
+            if self.splay:
+                self.sleep(self.random.uniform(0, self.splay))
+            profile = {"ManagedUser": "student", "FileName": "lab.plist",
+                       "ServerURL": self.server.url, "Sources": [self.server.url]}
+            self.result, _ = updater.syncProfile(profile, self.path, {}, self.pool, False)
+        finally:
+            self.pool.close()
+            self.seconds = (time.time() - started) / self.timescale
+
+def simulate(clients, splay, args, body, folder):
+    '''runs one boot of the lab and returns what it measured'''
+    updater.METRICS = updater.Metrics()
+    server = FleetServer(body, args.service, args.capacity, args.retry_after,
+                         args.timescale)
+    start = threading.Event()
+    try:
+        fleet = [Client(index, server, os.path.join(folder, "splay%s" % splay), splay,
+                        args.timescale, args.retries, start)
+                 for index in range(clients)]
+        for client in fleet:
+            client.start()
+        start.set()
+        for client in fleet:
+            client.join()
+    finally:
+        server.close()
+    synced = [client.seconds for client in fleet if client.result in ("updated", "synced")]
+    return {"Clients": clients,
+            "Splay": splay,
+            "Synced": len(synced),
+            "Failed": clients - len(synced),
+            "PeakConcurrency": server.peak,
+            "P50TimeToSync": percentile(synced, 50),
+            "P99TimeToSync": percentile(synced, 99),
+            "BytesServed": server.bytes,
+            "Requests": sum(server.statuses.values()),
+            "Statuses": dict((str(status), count)
+                             for status, count in sorted(server.statuses.items())),
+            "Retries": updater.METRICS.counters.get("retries", 0)}
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulates a lab of updaters syncing from one server at boot.")
+    parser.add_argument("--clients", type=int, default=200,
+                        help="number of Macs in the lab")
+    parser.add_argument("--splays", default="0,30,120",
+                        help="comma separated Splay settings to compare, in seconds")
+    parser.add_argument("--service", type=float, default=0.5,
+                        help="seconds the server takes per request")
+    parser.add_argument("--capacity", type=int, default=50,
+                        help="requests in flight before the server answers 503, 0 for no limit")
+    parser.add_argument("--retry-after", type=int, default=5,
+                        help="Retry-After the server sends with a 503, in seconds")
+    parser.add_argument("--retries", type=int, default=3,
+                        help="retries of each client's ConnectionPool")
+    parser.add_argument("--size", type=int, default=40,
+                        help="apps in the served plist")
+    parser.add_argument("--timescale", type=float, default=0.1,
+                        help="real seconds per simulated second")
+    parser.add_argument("--output", help="file to write the JSON results to, "
+                                         "instead of stdout")
+    args = parser.parse_args()
+    splays = [float(splay) for splay in args.splays.split(",")]
+    body = docksetup(args.size)
+    folder = tempfile.mkdtemp(prefix="dock-maintainer-fleet.")
+    try:
+        results = [simulate(args.clients, splay, args, body, folder) for splay in splays]
+    finally:
+        shutil.rmtree(folder, True)
+    parameters = {"Clients": args.clients, "Splays": splays, "Service": args.service,
+                  "Capacity": args.capacity, "RetryAfter": args.retry_after,
+                  "Retries": args.retries, "Size": args.size, "Timescale": args.timescale}
+    writeResults("fleet", parameters, results, args.output)
+
+if __name__ == '__main__':
+    main()
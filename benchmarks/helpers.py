@@ -0,0 +1,67 @@
+'''
+Shared bits of the benchmarks: loading the two scripts as modules, timing
+repeated runs and writing the results as JSON. Off a Mac, the Foundation
+stand-in of the tests is used in place of PyObjC.
+'''
+import imp
+import json
+import os
+import platform
+import sys
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+
+try:
+    import Foundation
+except ImportError:
+    sys.path.insert(0, os.path.join(ROOT, "tests"))
+
+def loadScript(name):
+    '''
+    Returns the script name, e.g. "dock-maintainer", loaded as a module.
+    Its log records are dropped rather than written.
+    '''
+    module = imp.load_source(name.replace("-", "_"), os.path.join(ROOT, name + ".py"))
+    module.LOG_WRITER.handlers = []
+    return module
+
+def summarize(samples):
+    '''returns the min, median and max of a list of seconds'''
+    ordered = sorted(samples)
+    return {"Min": round(ordered[0], 6),
+            "Median": round(ordered[len(ordered) // 2], 6),
+            "Max": round(ordered[-1], 6)}
+
+class Timer(object):
+    '''collects the seconds each phase took over repeated runs'''
+    def __init__(self):
+        self.samples = {}
+
+    def time(self, phase, func, *args):
+        '''calls func, adding its seconds to phase, and returns its result'''
+        start = time.time()
+        result = func(*args)
+        self.samples.setdefault(phase, []).append(time.time() - start)
+        return result
+
+    def phases(self):
+        '''returns the summary of every phase'''
+        return dict((phase, summarize(samples))
+                    for phase, samples in self.samples.items())
+
+def writeResults(benchmark, parameters, results, output=None):
+    '''writes the results of benchmark to output, a path, or stdout'''
+    record = {"Benchmark": benchmark,
+              "Python": platform.python_version(),
+              "Platform": platform.platform(),
+              "Finished": round(time.time(), 3),
+              "Parameters": parameters,
+              "Results": results}
+    text = json.dumps(record, indent=2, separators=(",", ": "), sort_keys=True) + "\n"
+    if output:
+        with open(output, "w") as resultsfile:
+            resultsfile.write(text)
+    else:
+        sys.stdout.write(text)
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+'''
+Times the phases of matching a Dock to its config over synthetic Docks of
+growing size, through the in-memory and the plist file backends, and writes
+the min, median and max seconds of each phase as JSON.
+
+The config lists size apps and a tenth as many folders, all present on disk.
+The Dock starts out drifted from it the way users drift it: some apps
+removed, some moved and some of their own added. Phases:
+
+    config_parse  loadConfig of the config plist
+    dock_load     reading the Dock sections through the backend
+    diff          diffLabels of the Dock's app labels against the config's
+    tile_build    building a tile for every app of the config, without a cache
+    match         matchDock, the in-memory reconcile the diff and builds are part of
+    commit        writing the changed sections and restarting the Dock
+
+Each run then reconciles a freshly drifted Dock again with a TileFactory kept
+across runs, as --watch does, and times that as tile_build_cached and
+match_cached. The cache's hits and misses over all runs are reported next to
+the phases. The first run fills the cache, so it only pays off from the
+second on, and only while the config fits in the cache.
+'''
+import argparse
+import os
+import plistlib
+import random
+import shutil
+import tempfile
+
+from helpers import Timer, loadScript, writeResults
+
+agent = loadScript("dock-maintainer")
+
+KEYS = {"LockDock": False, "MissingItemPolicy": None}
+
+def makeConfig(folder, size):
+    '''
+    Creates size apps and a tenth as many folders under folder and a config
+    listing them. Returns the config's path.
+    '''
+    apps = [os.path.join(folder, "Applications", "App %05d.app" % index)
+            for index in range(size)]
+    others = [os.path.join(folder, "Shared", "Folder %05d" % index)
+              for index in range(max(1, size // 10))]
+    for thePath in apps + others:
+        os.makedirs(thePath)
+    configFile = os.path.join(folder, "config.plist")
+    plistlib.writePlist({"Apps": apps, "Others": others}, configFile)
+    return configFile
+
+def driftedDock(config, seed):
+    '''
+    Returns the Dock sections for config as a user may have left them:
+    every tenth app gone, a few swapped with their neighbour and a few of
+    their own added
+    '''
+    rand = random.Random(seed)
+    dock = agent.Dock(agent.MemoryBackend())
+    apps = [dock.makeDockAppEntry(entry["Path"]).toItem()
+            for index, entry in enumerate(config["Apps"]) if index % 10 != 9]
+    for _ in range(len(apps) // 15):
+        index = rand.randrange(max(1, len(apps) - 1))
+        apps[index:index + 2] = apps[index:index + 2][::-1]
+    for index in range(len(apps) // 20):
+        own = agent.Tile("Own %d" % index, agent.fileURL("/Users/student/Own %d.app" % index),
+                         'file-tile', (('file-type', 41),))
+        apps.insert(rand.randrange(len(apps) + 1), own.toItem())
+    others = [dock.makeDockOtherEntry(entry["Path"], 0, 1, 3).toItem()
+              for entry in config["Others"]]
+    return {"persistent-apps": apps, "persistent-others": others[1:]}
+
+def memoryBackend(folder, sections):
+    '''returns a MemoryBackend holding the Dock sections'''
+    return agent.MemoryBackend({agent.Dock._DOMAIN: dict(sections)})
+
+def plistBackend(folder, sections):
+    '''returns a PlistFileBackend over a Dock plist holding the sections'''
+    plistlib.writePlist(sections, os.path.join(folder, agent.Dock._DOMAIN + ".plist"))
+    return agent.PlistFileBackend(folder)
+
+BACKENDS = [("memory", memoryBackend), ("plist", plistBackend)]
+
+def buildTiles(dock, paths):
+    '''builds the app tile of every path'''
+    return [dock.makeDockAppEntry(thePath) for thePath in paths]
+
+def benchmark(folder, size, makeBackend, repeat, cachesize):
+    '''returns the phase summary of repeat reconciles of a Dock of size apps
+        and the counts of the TileFactory of cachesize tiles'''
+    configFile = makeConfig(os.path.join(folder, "config"), size)
+    config = agent.loadConfig(configFile)
+    sections = driftedDock(config, size)
+    paths = [entry["Path"] for entry in config["Apps"]]
+    desired = [entry["Label"] for entry in config["Apps"]]
+    prefsdir = os.path.join(folder, "Preferences")
+    os.mkdir(prefsdir)
+    timer = Timer()
+    tiles = agent.TileFactory(cachesize)
+    for _ in range(repeat):
+        agent.METRICS.reset()
+        backend = makeBackend(prefsdir, sections)
+        config = timer.time("config_parse", agent.loadConfig, configFile)
+        dock = timer.time("dock_load", agent.Dock, backend)
+        current = [item.label for item in dock.items['persistent-apps']]
+        timer.time("diff", agent.diffLabels, current, desired)
+        timer.time("tile_build", buildTiles, dock, paths)
+        timer.time("match", agent.matchDock, config, dock, KEYS)
+        if not timer.time("commit", dock.save):
+            raise AssertionError("the drifted Dock of %d apps was not changed" % size)
+        dock = agent.Dock(makeBackend(prefsdir, sections), tiles)
+        timer.time("tile_build_cached", buildTiles, dock, paths)
+        dock = agent.Dock(makeBackend(prefsdir, sections), tiles)
+        timer.time("match_cached", agent.matchDock, config, dock, KEYS)
+    return timer.phases(), {"MaxSize": cachesize, "Hits": tiles.hits,
+                            "Misses": tiles.misses}
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times the phases of matching synthetic Docks to their config.")
+    parser.add_argument("--sizes", default="10,100,1000",
+                        help="comma separated numbers of apps in the config")
+    parser.add_argument("--backends", default=",".join(name for name, _ in BACKENDS),
+                        help="comma separated backends to run through")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="runs per size and backend")
+    parser.add_argument("--cache-size", type=int, default=agent.TileFactory().maxsize,
+                        help="tiles the TileFactory keeps, by default as many as --watch")
+    parser.add_argument("--output", help="file to write the JSON results to, "
+                                         "instead of stdout")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    backends = [(name, make) for name, make in BACKENDS
+                if name in args.backends.split(",")]
+    results = []
+    for name, makeBackend in backends:
+        for size in sizes:
+            folder = tempfile.mkdtemp(prefix="dock-maintainer-bench.")
+            try:
+                phases, cache = benchmark(folder, size, makeBackend, args.repeat,
+                                          args.cache_size)
+                results.append({"Backend": name, "Size": size, "Phases": phases,
+                                "TileCache": cache})
+            finally:
+                shutil.rmtree(folder, True)
+    writeResults("reconcile", {"Sizes": sizes, "Repeat": args.repeat,
+                               "CacheSize": args.cache_size}, results, args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/python
+'''
+Times the login agent from a fresh interpreter, as the LaunchAgent starts
+it, on its three paths, and writes the min, median and max seconds of each
+as JSON:
+
+    unmanaged     the user has no config and the agent exits at once
+    managed_cold  no fingerprint yet, so the Dock is read, matched and written
+    managed_fast  the fingerprint matches and the run ends before Foundation
+
+Wall is the whole run as the parent sees it, interpreter start included.
+Script is the time from the first line of the script to the end of login().
+Every run gets a throwaway home and the Foundation stand-in of the tests, so
+the real Dock is never touched. When PyObjC is installed the seconds a fresh
+interpreter takes to import the real Foundation, the cost the fast path
+avoids, are reported as foundation_import.
+'''
+import argparse
+import json
+import os
+import plistlib
+import pwd
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from helpers import ROOT, summarize, writeResults
+
+TESTS = os.path.join(ROOT, "tests")
+
+# runs one login and reports how long the script took and whether
+# Foundation got imported
+LOGIN = '''
+import imp, json, sys, time
+sys.path.insert(0, %(tests)r)
+agent = imp.load_source("dock_maintainer", %(script)r)
+agent.LOG_WRITER.handlers = []
+agent.CONFIG_PATH = %(configs)r
+agent.FoundationBackend.restartDock = lambda self: None
+try:
+    agent.login(session=True)
+except SystemExit:
+    pass
+print json.dumps({"Script": time.time() - agent._START,
+                  "Foundation": "Foundation" in sys.modules,
+                  "FastPath": bool(agent.METRICS.fields.get("FastPath"))})
+'''
+
+class Home(object):
+    '''
+    A throwaway home and config folder for the current user, who is
+    managed with a config of apps apps once manage() is called
+    '''
+    def __init__(self, folder, apps):
+        self.folder = folder
+        self.home = os.path.join(folder, "home")
+        self.configs = os.path.join(folder, "configs")
+        self.prefs = os.path.join(self.home, "Library", "Preferences")
+        os.makedirs(self.prefs)
+        os.mkdir(self.configs)
+        self.username = pwd.getpwuid(os.getuid()).pw_name
+        self.apps = [os.path.join(folder, "Applications", "App %03d.app" % index)
+                     for index in range(apps)]
+
+    def manage(self):
+        '''makes the user managed'''
+        for thePath in self.apps:
+            if not os.path.isdir(thePath):
+                os.makedirs(thePath)
+        plistlib.writePlist({"Apps": self.apps, "Others": []},
+                            os.path.join(self.configs, self.username))
+        plistlib.writePlist({"ManagedUser": self.username},
+                            os.path.join(self.prefs,
+                                         "com.github.wardsparadox.dock-maintainer.plist"))
+
+    def forget(self):
+        '''empties the Dock and drops the fingerprint, for a cold run'''
+        plistlib.writePlist({"persistent-apps": [], "persistent-others": []},
+                            os.path.join(self.prefs, "com.apple.dock.plist"))
+        shutil.rmtree(os.path.join(self.home, "Library", "Application Support"), True)
+
+    def login(self):
+        '''returns the child's report of one login, with its Wall seconds'''
+        code = LOGIN % {"tests": TESTS, "configs": self.configs,
+                        "script": os.path.join(ROOT, "dock-maintainer.py")}
+        start = time.time()
+        output = subprocess.check_output([sys.executable, "-c", code],
+                                         env=dict(os.environ, HOME=self.home))
+        report = json.loads(output.strip().splitlines()[-1])
+        report["Wall"] = time.time() - start
+        return report
+
+def scenario(name, runs):
+    '''returns the result of one path from the reports of its runs'''
+    for report in runs:
+        if report["FastPath"] != (name == "managed_fast"):
+            raise AssertionError("%s run took the wrong path: %s" % (name, report))
+    return {"Path": name,
+            "Wall": summarize([report["Wall"] for report in runs]),
+            "Script": summarize([report["Script"] for report in runs]),
+            "Foundation": any(report["Foundation"] for report in runs)}
+
+def foundationImport(repeat):
+    '''returns the seconds of a fresh import of PyObjC's Foundation, or
+        None when it is not installed'''
+    samples = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            if subprocess.call([sys.executable, "-c", "import Foundation"],
+                               stderr=devnull) != 0:
+                return None
+            samples.append(time.time() - start)
+    bare = []
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.call([sys.executable, "-c", "pass"])
+        bare.append(time.time() - start)
+    return {"Path": "foundation_import",
+            "Wall": summarize([max(0, sample - min(bare)) for sample in samples])}
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times cold and warm logins of the agent in fresh interpreters.")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="runs per path")
+    parser.add_argument("--apps", type=int, default=20,
+                        help="apps in the managed config")
+    parser.add_argument("--output", help="file to write the JSON results to, "
+                                         "instead of stdout")
+    args = parser.parse_args()
+    folder = tempfile.mkdtemp(prefix="dock-maintainer-startup.")
+    try:
+        home = Home(folder, args.apps)
+        results = [scenario("unmanaged", [home.login() for _ in range(args.repeat)])]
+        home.manage()
+        cold = []
+        for _ in range(args.repeat):
+            home.forget()
+            cold.append(home.login())
+        results.append(scenario("managed_cold", cold))
+        results.append(scenario("managed_fast", [home.login() for _ in range(args.repeat)]))
+    finally:
+        shutil.rmtree(folder, True)
+    foundation = foundationImport(args.repeat)
+    if foundation:
+        results.append(foundation)
+    writeResults("startup", {"Repeat": args.repeat, "Apps": args.apps}, results,
+                 args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+'''
+Writes the manifest.json that dock-maintainer-updater.py reads when UseManifest
+is set. Run it on the server against the folder holding the docksetup plists
+every time one of them changes.
+'''
+import argparse
+import hashlib
+import json
+import os
+import plistlib
+from xml.parsers.expat import ExpatError
+
+MANIFEST_NAME = "manifest.json"
+
+def hashFile(filepath):
+    '''
+    Returns the SHA-256 hex digest of the file at filepath
+    '''
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as contents:
+        for chunk in iter(lambda: contents.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def isDockSetup(filepath):
+    '''
+    Returns True if filepath is a plist with the Apps and Others arrays
+    '''
+    try:
+        plist = plistlib.readPlist(filepath)
+    except (IOError, ExpatError):
+        return False
+    return isinstance(plist, dict) and "Apps" in plist and "Others" in plist
+
+def buildManifest(folder, checksums=False):
+    '''
+    Returns the manifest for every docksetup plist in folder, writing a
+    <name>.sha256 file next to each one as well if checksums is True
+    '''
+    profiles = {}
+    for name in sorted(os.listdir(folder)):
+        filepath = os.path.join(folder, name)
+        if name.startswith(".") or not os.path.isfile(filepath):
+            continue
+        if not isDockSetup(filepath):
+            continue
+        sha256 = hashFile(filepath)
+        info = os.stat(filepath)
+        profiles[name] = {"Size": info.st_size,
+                          "SHA256": sha256,
+                          "Version": int(info.st_mtime)}
+        if checksums:
+            with open(filepath + ".sha256", "w") as checksumfile:
+                checksumfile.write("%s  %s\n" % (sha256, name))
+    return {"Version": 1, "Profiles": profiles}
+
+def main():
+    '''
+    Writes manifest.json into the folder given on the command line
+    '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("folder", help="folder holding the docksetup plists")
+    parser.add_argument("--checksums", action="store_true",
+                        help="also write <name>.sha256 files for VerifyChecksum")
+    args = parser.parse_args()
+    manifest = buildManifest(args.folder, args.checksums)
+    manifestpath = os.path.join(args.folder, MANIFEST_NAME)
+    temppath = manifestpath + ".tmp"
+    with open(temppath, "w") as manifestfile:
+        json.dump(manifest, manifestfile, indent=2, sort_keys=True)
+    os.chmod(temppath, 0644)
+    os.rename(temppath, manifestpath)
+    print "Wrote %s with %d profiles" % (manifestpath, len(manifest["Profiles"]))
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,996 @@
 #!/usr/bin/python
 '''
- Downloads file as needed for dock-maintainer. Sets extended attribute to be
- the last mod date for the plist according to the server. Suggested work around
- by elios on macadmins.org
+ Downloads file as needed for dock-maintainer. Downloads are kept in a content
+ addressed store, blobs/<sha256>, and each ManagedUser is a symlink to the blob
+ it uses. Freshness is a matter of comparing digests, users with the same
+ config share one blob and the last few blobs are kept for --rollback.
+
+ The Last-Modified and ETag validators from the server are kept in a small
+ state file so the next run can make a conditional request and skip the
+ download entirely when the server answers 304 Not Modified.
+
+ Several managed users can be listed in the Profiles preference. They are
+ fetched in parallel by a small thread pool that shares keep-alive
+ connections per server.
+
+ Each downloaded plist is also compiled into a JSON snapshot next to it with
+ labels, normalised paths and app tiles worked out, so the login agent does
+ not have to redo that at every login.
+
+ With UseManifest set, a manifest.json at each ServerURL (see
+ dock-maintainer-manifest.py) lists the size and SHA-256 of every plist, so
+ one request tells which cached plists are current and only the changed
+ ones are downloaded.
 '''
-import urllib2
-import datetime
-from time import mktime
+import urllib
+import urlparse
+import httplib
+import socket
+import threading
+import time
+import random
+from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager
+import argparse
 import os
 import logging
-import xattr
-from Foundation import CFPreferencesCopyAppValue
+import logging.handlers
+import Queue
+import atexit
+import plistlib
+import hashlib
+import tempfile
+import json
+import zlib
+import email.utils
+from xml.parsers.expat import ExpatError
+from Foundation import CFPreferencesCopyAppValue, NSURL
 
-logging.basicConfig(format='%(asctime)s - %(levelname)s: %(message)s',
-                    datefmt='%Y-%m-%d %I:%M:%S %p',
-                    level=logging.INFO,
-                    filename=os.path.normpath("/Library/Logs/dock-maintainer.log"))
-stdout_logging = logging.StreamHandler()
-stdout_logging.setFormatter(logging.Formatter())
-logging.getLogger().addHandler(stdout_logging)
+_START = time.time()
 
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUPS = 5
+LOG_QUEUE_SIZE = 1000
 
-def downloadFile(url, filepath, attributedate):
+class GzipRotatingFileHandler(logging.handlers.RotatingFileHandler):
     '''
-    Downloads url to filepath
+    A RotatingFileHandler that gzips the files it rotates out, keeping
+    them as <log>.1.gz, the newest, up to <log>.<backupCount>.gz
     '''
-    with open(filepath, "wb") as code:
-        code.write(url.read())
-    xattr.setxattr(filepath, 'dock-maintainer.Last-Modified-date', str(attributedate))
-    logging.info("Downloaded File to %s", filepath)
-    return filepath
+    def doRollover(self):
+        import gzip
+        import shutil
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        for index in range(self.backupCount - 1, 0, -1):
+            source = "%s.%d.gz" % (self.baseFilename, index)
+            if os.path.exists(source):
+                os.rename(source, "%s.%d.gz" % (self.baseFilename, index + 1))
+        if os.path.exists(self.baseFilename):
+            with open(self.baseFilename, "rb") as source:
+                with gzip.open(self.baseFilename + ".1.gz", "wb") as target:
+                    shutil.copyfileobj(source, target)
+            os.remove(self.baseFilename)
+        if not self.delay:
+            self.stream = self._open()
 
-def wait_for_internet_connection():
+class LogWriter(threading.Thread):
     '''
-    Shameless swipe from stackoverflow.
-    https://stackoverflow.com/a/10609378
+    Hands queued log records to the real handlers on a background thread,
+    so logging only costs the caller a put on a bounded queue. Records
+    that find the queue full are dropped and counted instead of waited on.
     '''
-    while True:
+    def __init__(self, handlers, maxsize=LOG_QUEUE_SIZE):
+        threading.Thread.__init__(self, name="LogWriter")
+        self.daemon = True
+        self.handlers = handlers
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, record):
+        '''queues record without ever blocking'''
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        '''writes out what is queued and closes the handlers'''
+        self.queue.put(None)
+        self.join()
+        if self.dropped:
+            record = logging.makeLogRecord(
+                {"levelno": logging.WARNING, "levelname": "WARNING",
+                 "msg": "Dropped %d log records, the log queue was full" % self.dropped})
+            for handler in self.handlers:
+                handler.handle(record)
+        for handler in self.handlers:
+            handler.close()
+
+class QueueHandler(logging.Handler):
+    '''
+    Passes records on to a LogWriter, with the message merged in first so
+    they no longer refer to arguments the caller may change
+    '''
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.writer.put(record)
+        except Exception:
+            self.handleError(record)
+
+def setupLogging(filename):
+    '''
+    Sends the root logger through a LogWriter to stdout and to filename,
+    rotated at LOG_MAX_BYTES with LOG_BACKUPS gzipped copies. The file is
+    only opened once the first record is written.
+    '''
+    file_logging = GzipRotatingFileHandler(filename, maxBytes=LOG_MAX_BYTES,
+                                           backupCount=LOG_BACKUPS, delay=True)
+    file_logging.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s: %(message)s',
+                                                datefmt='%Y-%m-%d %I:%M:%S %p'))
+    stdout_logging = logging.StreamHandler()
+    stdout_logging.setFormatter(logging.Formatter())
+    writer = LogWriter([file_logging, stdout_logging])
+    writer.start()
+    atexit.register(writer.stop)
+    logging.getLogger().addHandler(QueueHandler(writer))
+    logging.getLogger().setLevel(logging.INFO)
+    return writer
+
+def setLogLevel(level):
+    '''
+    Sets the log level from the LogLevel preference, a name such as DEBUG
+    or WARNING. Unset or unknown values leave it at INFO.
+    '''
+    if not level:
+        return
+    value = logging.getLevelName(str(level).upper())
+    if isinstance(value, int):
+        logging.getLogger().setLevel(value)
+    else:
+        logging.warning("Unknown LogLevel %s, logging at INFO", level)
+
+LOG_WRITER = setupLogging("/Library/Logs/dock-maintainer.log")
+
+
+SUPPORT_PATH = "/Library/Application Support/com.github.wardsparadox.dock-maintainer"
+CHUNK_SIZE = 64 * 1024
+METRICS_PATH = "/Library/Logs/dock-maintainer-metrics.log"
+PROFILE_ENV = "DOCK_MAINTAINER_PROFILE"
+
+class DownloadError(Exception):
+    '''Basic exception'''
+    pass
+
+class Metrics(object):
+    '''
+    Times the phases of a run and counts what it did, then appends both as
+    one JSON line to the metrics log for the log shipper to aggregate.
+    Profiles are synced in parallel, so phases timed in the workers add up
+    the time of every worker and may exceed the run.
+    '''
+    def __init__(self, started=None):
+        self.started = started or time.time()
+        self.phases = {}
+        self.counters = {}
+        self.fields = {}
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        '''adds seconds to the time spent in phase'''
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    @contextmanager
+    def span(self, phase):
+        '''times the with block as part of phase'''
+        start = time.time()
         try:
-            response = urllib2.urlopen('https://www.google.com/', timeout=1)
+            yield
+        finally:
+            self.add(phase, time.time() - start)
+
+    def count(self, counter, amount=1):
+        '''adds amount to counter'''
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def set(self, **fields):
+        '''sets top level fields of the record'''
+        with self._lock:
+            self.fields.update(fields)
+
+    def record(self):
+        '''returns the record of the run so far'''
+        with self._lock:
+            record = {"Script": "dock-maintainer-updater",
+                      "Host": os.uname()[1],
+                      "Started": round(self.started, 3),
+                      "Seconds": round(time.time() - self.started, 4),
+                      "Phases": dict((phase, round(seconds, 4))
+                                     for phase, seconds in self.phases.items()),
+                      "Counters": dict(self.counters)}
+            record.update(self.fields)
+        return record
+
+    def write(self, path=METRICS_PATH):
+        '''appends the record to path'''
+        try:
+            with open(path, "a") as metricsfile:
+                metricsfile.write(json.dumps(self.record(), sort_keys=True) + "\n")
+        except (IOError, OSError) as err:
+            logging.warning("Could not write metrics: %s", err)
+
+METRICS = Metrics(_START)
+
+def runProfiled(statspath, func, *args):
+    '''
+    Calls func under cProfile and dumps the stats to statspath, for reading
+    with pstats, even when func exits
+    '''
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        profiler.dump_stats(statspath)
+        logging.info("Wrote profile to %s", statspath)
+
+BLOBS = "blobs"
+HISTORY_LENGTH = 5
+STALE_DOWNLOAD = 3600
+
+def downloadFile(url, blobdir, sha256=None, validate=None):
+    '''
+    Streams url into the store at blobdir and returns its digest. The data
+    goes to a temp file that is checked against sha256 and validate, a
+    function of the file's path, if given, then renamed to its digest, so
+    a blob is never seen half written.
+    '''
+    digest = hashlib.sha256()
+    fd, temppath = tempfile.mkstemp(prefix=".", suffix=".download", dir=blobdir)
+    try:
+        with os.fdopen(fd, "wb") as code:
+            while True:
+                chunk = url.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                code.write(chunk)
+            code.flush()
+            os.fsync(code.fileno())
+        if sha256 and digest.hexdigest() != sha256.lower():
+            raise DownloadError("Checksum mismatch: expected %s, got %s"
+                                % (sha256, digest.hexdigest()))
+        if validate and not validate(temppath):
+            raise DownloadError("Download is not a docksetup plist")
+        # mkstemp creates the file 0600, the login agent needs to read it
+        os.chmod(temppath, 0644)
+        os.rename(temppath, os.path.join(blobdir, digest.hexdigest()))
+    except BaseException:
+        os.remove(temppath)
+        raise
+    syncFolder(blobdir)
+    logging.info("Downloaded File to %s", os.path.join(blobdir, digest.hexdigest()))
+    return digest.hexdigest()
+
+def syncFolder(folder):
+    '''
+    Flushes renames in folder to disk
+    '''
+    dirfd = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+def currentDigest(path, user):
+    '''
+    Returns the digest of the blob user points to, or None. A plain file
+    left by an older version is moved into the store first.
+    '''
+    linkpath = os.path.join(path, user)
+    if os.path.islink(linkpath):
+        digest = os.path.basename(os.readlink(linkpath))
+        if os.path.isfile(os.path.join(path, BLOBS, digest)):
+            return digest
+        return None
+    if os.path.isfile(linkpath):
+        digest = hashFile(linkpath)
+        os.rename(linkpath, os.path.join(path, BLOBS, digest))
+        pointProfile(path, user, digest)
+        logging.info("%s: Moved cached plist into the store", user)
+        return digest
+    return None
+
+def pointProfile(path, user, digest):
+    '''
+    Points user at the blob digest by renaming a new symlink over the old
+    one, so the login agent sees either the old or the new config
+    '''
+    temppath = os.path.join(path, ".%s.link" % user)
+    if os.path.lexists(temppath):
+        os.remove(temppath)
+    os.symlink(os.path.join(BLOBS, digest), temppath)
+    os.rename(temppath, os.path.join(path, user))
+    syncFolder(path)
+
+def collectGarbage(path, state):
+    '''
+    Removes blobs, and their snapshots, that no user link in path points
+    to and that are not in any user's rollback history, and downloads left
+    behind by runs that ended before they finished. Links are what the
+    login agent reads, so every one of them counts whether or not its user
+    is in state.
+    '''
+    keep = set()
+    for userstate in state.values():
+        keep.update(userstate.get("History", []))
+    for name in os.listdir(path):
+        if os.path.islink(os.path.join(path, name)):
+            keep.add(os.path.basename(os.readlink(os.path.join(path, name))))
+    blobdir = os.path.join(path, BLOBS)
+    for name in os.listdir(blobdir):
+        if name.startswith("."):
+            if (name.endswith(".download") and
+                    time.time() - os.path.getmtime(os.path.join(blobdir, name)) > STALE_DOWNLOAD):
+                os.remove(os.path.join(blobdir, name))
+            continue
+        if name.split(".")[0] not in keep:
+            os.remove(os.path.join(blobdir, name))
+            logging.info("Removed unused blob %s", name)
+
+def rollback(path, state, user):
+    '''
+    Points user back at the blob it used before the last update. It stays
+    there until the server publishes something other than the blob rolled
+    back from.
+    '''
+    userstate = state.get(user, {})
+    history = userstate.get("History", [])
+    current = currentDigest(path, user)
+    if not history:
+        logging.error("%s: Nothing to roll back to", user)
+        return False
+    previous = history.pop()
+    pointProfile(path, user, previous)
+    userstate["RolledBackFrom"] = current
+    state[user] = userstate
+    logging.info("%s: Rolled back from %s to %s", user, current, previous)
+    return True
+
+MANIFEST_NAME = "manifest.json"
+
+def validDigest(value):
+    '''
+    Returns True if value is a SHA-256 hex digest
+    '''
+    if not isinstance(value, basestring) or len(value) != 64:
+        return False
+    try:
+        int(value, 16)
+    except ValueError:
+        return False
+    return True
+
+def fetchManifest(pool, serverurl):
+    '''
+    Returns the Profiles dict of the manifest published at serverurl,
+    mapping file names to their Size, SHA256 and Version, or None when
+    there is no usable manifest. Entries without a valid SHA256 are left
+    out, so those profiles fall back to a conditional request.
+    '''
+    manifesturl = os.path.join(serverurl, MANIFEST_NAME)
+    try:
+        response = openURL(pool, manifesturl)
+        if response.status != 200:
+            response.close()
+            logging.info("No manifest at %s (HTTP %d)", manifesturl, response.status)
+            return None
+        profiles = json.loads(response.read())["Profiles"]
+        if not isinstance(profiles, dict):
+            raise TypeError("Profiles is not a dictionary")
+    except (httplib.HTTPException, socket.error, DownloadError) as err:
+        logging.error("Can not get manifest %s: %s", manifesturl, err)
+        return None
+    except (ValueError, KeyError, TypeError):
+        logging.error("Manifest %s is not valid", manifesturl)
+        return None
+    entries = {}
+    for name, entry in profiles.items():
+        if isinstance(entry, dict) and validDigest(entry.get("SHA256")):
+            entries[name] = entry
+        else:
+            logging.error("Manifest %s has no valid SHA256 for %s, ignoring it",
+                          manifesturl, name)
+    return entries
+
+def hashFile(filepath):
+    '''
+    Returns the SHA-256 hex digest of the file at filepath
+    '''
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as contents:
+        for chunk in iter(lambda: contents.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def isDockSetup(filepath):
+    '''
+    Returns True if filepath is a plist with the Apps and Others arrays
+    '''
+    try:
+        plist = plistlib.readPlist(filepath)
+    except (IOError, ExpatError):
+        return False
+    return (isinstance(plist, dict) and
+            isinstance(plist.get("Apps"), list) and
+            isinstance(plist.get("Others"), list))
+
+def fetchChecksum(pool, completeurl):
+    '''
+    Returns the SHA-256 published by the server next to completeurl as
+    completeurl.sha256, in the format written by shasum -a 256
+    '''
+    response = openURL(pool, completeurl + ".sha256")
+    if response.status != 200:
+        response.close()
+        raise DownloadError("Can not get checksum for %s (HTTP %d)"
+                            % (completeurl, response.status))
+    return response.read().split()[0]
+
+SNAPSHOT_VERSION = 2
+
+def snapshotStale(plistfilepath):
+    '''
+    Returns True unless a snapshot of the current plistfilepath exists
+    '''
+    try:
+        with open(plistfilepath + ".snapshot") as snapshotfile:
+            snapshot = json.load(snapshotfile)
+        info = os.stat(plistfilepath)
+    except (IOError, OSError, ValueError):
+        return True
+    return (snapshot.get("Version") != SNAPSHOT_VERSION or
+            snapshot.get("SourceSize") != info.st_size or
+            snapshot.get("SourceMTime") != info.st_mtime)
+
+def compileSnapshot(plistfilepath):
+    '''
+    Compiles the plist at plistfilepath into plistfilepath.snapshot, a JSON
+    file the login agent loads in one read. It records the size and mtime
+    of the plist so the agent can tell when it is stale.
+    '''
+    with METRICS.span("plist_parse"):
+        config = plistlib.readPlist(plistfilepath)
+    info = os.stat(plistfilepath)
+    snapshot = {"Version": SNAPSHOT_VERSION,
+                "SourceSize": info.st_size,
+                "SourceMTime": info.st_mtime,
+                "Apps": [],
+                "Others": [],
+                "Merge": bool(config.get("Merge"))}
+    for app in config.get("Apps", []):
+        app = os.path.normpath(app)
+        label = os.path.splitext(os.path.basename(app))[0]
+        ns_url = unicode(NSURL.fileURLWithPath_(app).absoluteString())
+        snapshot["Apps"].append(
+            {"Path": app,
+             "Label": label,
+             "Tile": {'tile-data': {'file-data': {'_CFURLString': ns_url,
+                                                  '_CFURLStringType': 15},
+                                    'file-label': label,
+                                    'file-type': 41},
+                      'tile-type': 'file-tile'}})
+    # ~ is left in, it can only be expanded for the user at login
+    for other in config.get("Others", []):
+        other = os.path.normpath(other)
+        snapshot["Others"].append(
+            {"Path": other,
+             "Label": os.path.splitext(os.path.basename(other))[0]})
+    temppath = plistfilepath + ".snapshot.tmp"
+    with open(temppath, "w") as snapshotfile:
+        json.dump(snapshot, snapshotfile)
+    os.chmod(temppath, 0644)
+    os.rename(temppath, plistfilepath + ".snapshot")
+
+def readState(statepath):
+    '''
+    Returns the validator state saved by the last run, keyed by ManagedUser
+    '''
+    try:
+        return plistlib.readPlist(statepath)
+    except (IOError, ExpatError):
+        return {}
+
+def writeState(statepath, state):
+    '''
+    Writes the validator state, replacing the old file in one rename
+    '''
+    temppath = statepath + ".tmp"
+    plistlib.writePlist(state, temppath)
+    os.rename(temppath, statepath)
+
+def makeHeaders(completeurl, validators):
+    '''
+    Returns the request headers for completeurl, made conditional on the
+    stored validators when they were saved for the same url
+    '''
+    headers = {}
+    if validators.get("URL") == completeurl:
+        if validators.get("ETag"):
+            headers["If-None-Match"] = validators["ETag"]
+        if validators.get("Last-Modified"):
+            headers["If-Modified-Since"] = validators["Last-Modified"]
+    return headers
+
+class PooledResponse(object):
+    '''
+    An httplib response that hands its connection back to the pool once the
+    body has been read to the end. A gzip encoded body is decoded as it is
+    read; bytes_wire and bytes_read count the body before and after that.
+    '''
+    def __init__(self, pool, key, conn, response):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.status = response.status
+        self._decoder = None
+        if (response.getheader("Content-Encoding") or "").lower() == "gzip":
+            # 16 + MAX_WBITS tells zlib to expect a gzip header
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def getheader(self, name, default=None):
+        '''returns a response header'''
+        return self._response.getheader(name, default)
+
+    def _read(self, amt=None):
+        '''reads the body as sent, releasing the connection at the end'''
+        data = self._response.read(amt)
+        METRICS.count("bytes_wire", len(data))
+        if self._response.isclosed() or amt is None or not data:
+            self.close()
+        return data
+
+    def read(self, amt=None):
+        '''reads the decoded body, releasing the connection at the end.
+            Like a file, returns "" only once the body is used up.'''
+        data = self._decode(amt)
+        METRICS.count("bytes_read", len(data))
+        return data
+
+    def _decode(self, amt=None):
+        '''returns the next piece of the decoded body'''
+        if self._decoder is None:
+            return self._read(amt)
+        try:
+            data = ""
+            while not data:
+                raw = self._read(amt)
+                if not raw:
+                    return self._decoder.flush()
+                data = self._decoder.decompress(raw)
+                if amt is None:
+                    data += self._decoder.flush()
+                    break
+            return data
+        except zlib.error as err:
+            self.close()
+            raise DownloadError("Can not decode gzip body: %s" % err)
+
+    def close(self):
+        '''drains and releases the connection'''
+        if self._conn is None:
             return
-        except urllib2.URLError:
-            pass
+        conn, self._conn = self._conn, None
+        if not self._response.isclosed():
+            try:
+                self._response.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                return
+        if self._response.will_close:
+            conn.close()
+        else:
+            self._pool.release(self._key, conn)
+
+RETRY_STATUSES = (429, 503)
+RETRY_AFTER_MAX = 120
+
+def retryAfter(value, clock=time.time):
+    '''
+    Returns the seconds to wait given by a Retry-After header, either a
+    number of seconds or an HTTP date, or None when there is none to read
+    '''
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0, email.utils.mktime_tz(parsed) - clock())
+
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+
+class ConnectionPool(object):
+    '''
+    Keeps idle keep-alive connections per scheme, host and port so several
+    profiles on one server share connections. Requests ask for gzip and
+    connections time out after CONNECT_TIMEOUT seconds connecting and
+    READ_TIMEOUT seconds without data. A busy server answering 503
+    or 429 is asked again up to retries times, after its Retry-After or an
+    exponential backoff, stretched by up to half again so clients told the
+    same wait do not all come back at once.
+    '''
+    MAX_REDIRECTS = 5
+
+    def __init__(self, retries=3, sleep=time.sleep, jitter=random.random):
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.retries = retries
+        self._sleep = sleep
+        self._jitter = jitter
+
+    def _connection(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, netloc = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout=CONNECT_TIMEOUT), False
+        return httplib.HTTPConnection(netloc, timeout=CONNECT_TIMEOUT), False
+
+    def release(self, key, conn):
+        '''returns a connection to the idle list'''
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def close(self):
+        '''closes every idle connection'''
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+
+    def request(self, url, headers=None, method="GET"):
+        '''
+        Sends a request and returns a PooledResponse, following redirects
+        and retrying when the server is busy. A reused connection the server
+        already closed is retried once fresh.
+        '''
+        sent = dict(headers or {})
+        sent.setdefault("Accept-Encoding", "gzip")
+        redirects = 0
+        attempt = 0
+        while redirects <= self.MAX_REDIRECTS:
+            parts = urlparse.urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            selector = urlparse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+            while True:
+                conn, reused = self._connection(key)
+                try:
+                    if not reused:
+                        conn.connect()
+                        conn.sock.settimeout(READ_TIMEOUT)
+                    conn.request(method, selector, headers=sent)
+                    response = conn.getresponse()
+                    break
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    if not reused:
+                        raise
+            pooled = PooledResponse(self, key, conn, response)
+            location = response.getheader("Location")
+            if response.status in (301, 302, 303, 307, 308) and location:
+                pooled.close()
+                url = urlparse.urljoin(url, location)
+                redirects += 1
+                continue
+            if response.status in RETRY_STATUSES and attempt < self.retries:
+                delay = retryAfter(response.getheader("Retry-After"))
+                if delay is None:
+                    delay = 2 ** attempt
+                if delay <= RETRY_AFTER_MAX:
+                    pooled.close()
+                    delay *= 1 + self._jitter() / 2.0
+                    logging.info("%s answered %d, retrying in %.1f seconds",
+                                 url, response.status, delay)
+                    METRICS.count("retries")
+                    with METRICS.span("retry_wait"):
+                        self._sleep(delay)
+                    attempt += 1
+                    continue
+            return pooled
+        raise DownloadError("Too many redirects for %s" % url)
+
+class FileResponse(object):
+    '''
+    A file:// url read like a PooledResponse, answering 200 when the file
+    can be opened and 404 when it can not, so a mirror on a local or shared
+    volume can stand in for a web server
+    '''
+    def __init__(self, url):
+        self._file = None
+        try:
+            self._file = open(urllib.url2pathname(urlparse.urlsplit(url).path), "rb")
+            self.status = 200
+        except IOError:
+            self.status = 404
+
+    def getheader(self, name, default=None):
+        '''files have no headers'''
+        return default
+
+    def read(self, amt=None):
+        '''reads the file'''
+        data = self._file.read() if amt is None else self._file.read(amt)
+        METRICS.count("bytes_read", len(data))
+        return data
+
+    def close(self):
+        '''closes the file'''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def openURL(pool, url, headers=None):
+    '''
+    Returns a FileResponse for a file:// url and the pool's response for
+    any other
+    '''
+    if url.startswith("file:"):
+        return FileResponse(url)
+    return pool.request(url, headers)
+
+PROBE_TIMEOUT = 5
+
+def serverReachable(serverurl):
+    '''
+    Returns True if the web server at serverurl answers a HEAD request with
+    any status, which is enough to know the network and server are up.
+    A file:// server is reachable when its folder exists.
+    '''
+    parts = urlparse.urlsplit(serverurl)
+    if parts.scheme == "file":
+        return os.path.isdir(urllib.url2pathname(parts.path))
+    if parts.scheme == "https":
+        conn = httplib.HTTPSConnection(parts.netloc, timeout=PROBE_TIMEOUT)
+    else:
+        conn = httplib.HTTPConnection(parts.netloc, timeout=PROBE_TIMEOUT)
+    try:
+        conn.request("HEAD", parts.path or "/")
+        conn.getresponse()
+        return True
+    except (httplib.HTTPException, socket.error):
+        return False
+    finally:
+        conn.close()
+
+def wait_for_server(probe, deadline, clock=time.time, sleep=time.sleep,
+                    jitter=random.random, initial=0.5, maximum=30):
+    '''
+    Calls probe until it returns True, sleeping between tries with an
+    exponential backoff of initial doubling up to maximum seconds, each
+    sleep randomised to between half and all of the current backoff.
+    Returns False once deadline seconds have passed without success.
+    '''
+    start = clock()
+    backoff = initial
+    while not probe():
+        remaining = deadline - (clock() - start)
+        if remaining <= 0:
+            return False
+        sleep(min(remaining, backoff / 2.0 * (1 + jitter())))
+        backoff = min(maximum, backoff * 2)
+    return True
+
+def firstSuccess(sources, attempt, hedge=None, timeout=None, clock=time.time):
+    '''
+    Calls attempt with each of sources in order, each in its own thread,
+    and returns the (source, result) of the first call to return a result
+    other than None, or (None, None) when none did. The next source is
+    started when a call fails, when a call has run for timeout seconds,
+    which gives up on it, and when the latest call has run for hedge
+    seconds, which leaves the earlier calls running alongside it.
+    '''
+    results = Queue.Queue()
+    running = {}
+    started = 0
+
+    def run(index):
+        '''puts the result of one attempt on results'''
+        try:
+            result = attempt(sources[index])
+        except Exception:
+            logging.exception("Fetching from %s failed", sources[index])
+            result = None
+        results.put((index, result))
+
+    while True:
+        now = clock()
+        if started < len(sources) and (
+                not running or
+                (hedge is not None and now - max(running.values()) >= hedge)):
+            if running:
+                logging.info("%s is slow, also trying %s",
+                             sources[max(running)], sources[started])
+                METRICS.count("hedges")
+            running[started] = now
+            thread = threading.Thread(target=run, args=(started,))
+            thread.daemon = True
+            thread.start()
+            started += 1
+            continue
+        if not running:
+            return None, None
+        waits = []
+        if timeout is not None:
+            waits.append(min(running.values()) + timeout - now)
+        if hedge is not None and started < len(sources):
+            waits.append(max(running.values()) + hedge - now)
+        try:
+            index, result = results.get(timeout=max(0, min(waits)) if waits else None)
+        except Queue.Empty:
+            for index, start in running.items():
+                if timeout is not None and clock() - start >= timeout:
+                    logging.error("%s took longer than %s seconds, giving up on it",
+                                  sources[index], timeout)
+                    del running[index]
+            continue
+        if index not in running:
+            continue
+        del running[index]
+        if result is not None:
+            return sources[index], result
+        METRICS.count("failovers")
+
+def getProfiles(keys):
+    '''
+    Returns the list of profiles to sync. Each profile is a dict with
+    ManagedUser, FileName, ServerURL and Mirrors, the last three
+    defaulting to the top level preferences. Sources lists ServerURL
+    followed by the Mirrors, in the order they are tried. Without a
+    Profiles preference the single ManagedUser and FileName preferences
+    make up the only profile.
+    '''
+    if keys["Profiles"]:
+        entries = keys["Profiles"]
+    else:
+        entries = [{"ManagedUser": keys["ManagedUser"]}]
+    profiles = []
+    for entry in entries:
+        profile = {"ManagedUser": entry.get("ManagedUser"),
+                   "FileName": entry.get("FileName", keys["FileName"]),
+                   "ServerURL": entry.get("ServerURL", keys["ServerURL"])}
+        profile["Sources"] = [profile["ServerURL"]] + list(
+            entry.get("Mirrors", keys["Mirrors"]) or [])
+        if profile["ManagedUser"] is None:
+            logging.error("Profile without ManagedUser found, skipping it")
+            continue
+        profiles.append(profile)
+    return profiles
+
+def syncProfile(profile, path, userstate, pool, verifychecksum, manifest=None,
+                hedge=None, timeout=None):
+    '''
+    Downloads the plist of one profile into the store if the server copy
+    changed and points the profile at it. When the manifest of its server
+    lists the plist, its digest decides that without asking the server and
+    verifies the download. The Sources of the profile are tried in order
+    as firstSuccess does with hedge and timeout; a source that fails, or
+    sends a plist that does not verify or is not a docksetup plist, passes
+    on to the next.
+    userstate holds the validators, History and RolledBackFrom of the
+    profile.
+    Returns a (result, userstate) tuple, result being one of
+    "synced", "updated" or "failed".
+    '''
+    user = profile["ManagedUser"]
+    entry = (manifest or {}).get(profile["FileName"])
+    userstate = dict(userstate)
+    current = currentDigest(path, user)
+    conditional = False
+    if current is None:
+        logging.info("%s: File not found! Downloading", user)
+    elif entry:
+        if entry["SHA256"].lower() in (current, userstate.get("RolledBackFrom")):
+            logging.info("%s: File is synced with manifest.", user)
+            return "synced", userstate
+    else:
+        conditional = True
+
+    def fetch(serverurl):
+        '''
+        Returns (completeurl, response, digest) for the plist at serverurl,
+        digest being None when the server answered 304, or None on failure
+        '''
+        completeurl = os.path.join(serverurl, profile["FileName"])
+        headers = makeHeaders(completeurl, userstate) if conditional else {}
+        try:
+            METRICS.count("requests")
+            with METRICS.span("http_fetch"):
+                fileurl = openURL(pool, completeurl, headers)
+        except (httplib.HTTPException, socket.error, DownloadError) as err:
+            logging.error("%s: Can not connect to url %s: %s", user, completeurl, err)
+            return None
+        if fileurl.status == 304:
+            fileurl.close()
+            return completeurl, fileurl, None
+        if fileurl.status != 200:
+            fileurl.close()
+            logging.error("%s: Can not connect to url %s (HTTP %d)",
+                          user, completeurl, fileurl.status)
+            return None
+        sha256 = entry["SHA256"] if entry else None
+        try:
+            if verifychecksum and not sha256:
+                with METRICS.span("checksum_fetch"):
+                    sha256 = fetchChecksum(pool, completeurl)
+            with METRICS.span("download"):
+                digest = downloadFile(fileurl, os.path.join(path, BLOBS), sha256,
+                                      isDockSetup)
+        except (httplib.HTTPException, socket.error, DownloadError) as err:
+            fileurl.close()
+            logging.error("%s: %s from %s", user, err, completeurl)
+            return None
+        return completeurl, fileurl, digest
+
+    source, result = firstSuccess(profile["Sources"], fetch, hedge, timeout)
+    if result is None:
+        logging.error("%s: No source gave a valid plist, keeping cached plist", user)
+        return "failed", userstate
+    completeurl, fileurl, digest = result
+    if source != profile["ServerURL"]:
+        logging.info("%s: Fetched from %s", user, source)
+    if digest is None:
+        logging.info("%s: File is synced.", user)
+        return "synced", userstate
+    userstate["URL"] = completeurl
+    for header in ("Last-Modified", "ETag"):
+        if fileurl.getheader(header):
+            userstate[header] = fileurl.getheader(header)
+        else:
+            userstate.pop(header, None)
+    if digest in (current, userstate.get("RolledBackFrom")):
+        logging.info("%s: File content is unchanged.", user)
+        return "synced", userstate
+    logging.info("%s: File is out of date", user)
+    pointProfile(path, user, digest)
+    if current:
+        userstate["History"] = (userstate.get("History", []) + [current])[-HISTORY_LENGTH:]
+    userstate.pop("RolledBackFrom", None)
+    return "updated", userstate
 
 def main():
     '''
     Main Controlling Module:
     - Checks preferences set
-    - Checks for Path, if not creates
-    - Downloads plist if needed
+    - Syncs, under cProfile when ProfilePath is set
     '''
     keys = {}
     keys["ManagedUser"] = CFPreferencesCopyAppValue("ManagedUser",
@@ -58,50 +1000,144 @@ def main():
                                                   "com.github.wardsparadox.dock-maintainer")
     keys["FileName"] = CFPreferencesCopyAppValue("FileName",
                                                  "com.github.wardsparadox.dock-maintainer")
+    keys["VerifyChecksum"] = CFPreferencesCopyAppValue("VerifyChecksum",
+                                                       "com.github.wardsparadox.dock-maintainer")
+    keys["Profiles"] = CFPreferencesCopyAppValue("Profiles",
+                                                 "com.github.wardsparadox.dock-maintainer")
+    keys["MaxWorkers"] = CFPreferencesCopyAppValue("MaxWorkers",
+                                                   "com.github.wardsparadox.dock-maintainer")
+    keys["NetworkWaitDeadline"] = CFPreferencesCopyAppValue("NetworkWaitDeadline",
+                                                            "com.github.wardsparadox.dock-maintainer")
+    keys["UseManifest"] = CFPreferencesCopyAppValue("UseManifest",
+                                                    "com.github.wardsparadox.dock-maintainer")
+    keys["ProfilePath"] = CFPreferencesCopyAppValue("ProfilePath",
+                                                    "com.github.wardsparadox.dock-maintainer")
+    keys["LogLevel"] = CFPreferencesCopyAppValue("LogLevel",
+                                                 "com.github.wardsparadox.dock-maintainer")
+    keys["Splay"] = CFPreferencesCopyAppValue("Splay",
+                                              "com.github.wardsparadox.dock-maintainer")
+    keys["Mirrors"] = CFPreferencesCopyAppValue("Mirrors",
+                                                "com.github.wardsparadox.dock-maintainer")
+    keys["HedgeAfter"] = CFPreferencesCopyAppValue("HedgeAfter",
+                                                   "com.github.wardsparadox.dock-maintainer")
+    keys["SourceTimeout"] = CFPreferencesCopyAppValue("SourceTimeout",
+                                                      "com.github.wardsparadox.dock-maintainer")
+    setLogLevel(keys["LogLevel"])
+    if keys["ProfilePath"] and not os.environ.get(PROFILE_ENV):
+        runProfiled(keys["ProfilePath"], sync, keys)
+    else:
+        sync(keys)
 
-    path = os.path.realpath("/Library/Application Support/com.github.wardsparadox.dock-maintainer")
+def sync(keys):
+    '''
+    Syncs the profiles configured in keys:
+    - Checks for Path, if not creates
+    - Downloads plists of all profiles if needed
+    Exits 1 if any profile failed.
+    '''
+    path = os.path.realpath(SUPPORT_PATH)
     if os.path.exists(path):
         logging.info("Path exists at %s", path)
     else:
         logging.info("Path not found, creating at %s", path)
         os.mkdir(path, 0755)
+    if not os.path.isdir(os.path.join(path, BLOBS)):
+        os.mkdir(os.path.join(path, BLOBS), 0755)
 
-    if keys["ManagedUser"] is None:
+    if keys["ManagedUser"] is None and not keys["Profiles"]:
         logging.error("No ManagedUser Preference set")
         exit(2)
-    else:
-        plistfilepath = os.path.join(path, keys["ManagedUser"])
-        completeurl = os.path.join(keys["ServerURL"], keys["FileName"])
+    profiles = getProfiles(keys)
+    servers = set(profile["ServerURL"] for profile in profiles)
+    sources = set(source for profile in profiles for source in profile["Sources"])
+    if keys["Splay"]:
+        splay = random.uniform(0, float(keys["Splay"]))
+        logging.info("Waiting %.1f of up to %s seconds of splay", splay, keys["Splay"])
+        with METRICS.span("splay"):
+            time.sleep(splay)
+    deadline = keys["NetworkWaitDeadline"]
+    if deadline is None:
+        deadline = 300
+    with METRICS.span("network_wait"):
+        reachable = wait_for_server(
+            lambda: any(serverReachable(source) for source in sources), deadline)
+    if not reachable:
+        logging.error("No server reachable after %s seconds, keeping cached plists",
+                      deadline)
+        exit(1)
+    statepath = os.path.join(path, ".updater-state.plist")
+    state = readState(statepath)
+    pool = ConnectionPool()
+    manifests = {}
+    if keys["UseManifest"]:
+        with METRICS.span("manifest_fetch"):
+            for server in servers:
+                manifests[server] = fetchManifest(pool, server)
+
+    def syncOne(profile):
+        '''syncs one profile, an unexpected error only failing that one'''
+        userstate = state.get(profile["ManagedUser"], {})
         try:
-            fileurl = urllib2.urlopen(completeurl)
-            meta = fileurl.info().getheaders("Last-Modified")[0]
-            servermod = datetime.datetime.fromtimestamp(mktime(
-                datetime.datetime.strptime(
-                    meta, "%a, %d %b %Y %X GMT").timetuple()))
-        except urllib2.HTTPError:
-            logging.error("Can not connect to url")
-            exit(1)
+            return syncProfile(profile, path, userstate, pool, keys["VerifyChecksum"],
+                               manifests.get(profile["ServerURL"]),
+                               keys["HedgeAfter"], keys["SourceTimeout"])
+        except Exception:
+            logging.exception("%s: Sync failed, keeping cached plist",
+                              profile["ManagedUser"])
+            return "failed", userstate
 
-    if not os.path.isfile(plistfilepath):
-        logging.info("File not found! Downloading")
-        downloadFile(fileurl, plistfilepath, servermod)
-        exit(0)
+    workers = ThreadPool(max(1, min(int(keys["MaxWorkers"] or 4), len(profiles))))
+    try:
+        results = workers.map(syncOne, profiles)
+    finally:
+        workers.close()
+        pool.close()
 
-    if xattr.listxattr(plistfilepath):
-        logging.info("Got File Attributes")
-    else:
-        logging.info("No Attributes found! Downloading and setting them")
-        downloadFile(fileurl, plistfilepath, servermod)
-        exit(0)
-    filexattrdate = xattr.getxattr(plistfilepath,
-                                   'dock-maintainer.Last-Modified-date')
-    if str(servermod) != filexattrdate:
-        logging.info("File is out of date")
-        downloadFile(fileurl, plistfilepath, servermod)
-    else:
-        logging.info("File is synced.")
-        exit(0)
+    failed = 0
+    for profile, (result, userstate) in zip(profiles, results):
+        logging.info("%s: %s", profile["ManagedUser"], result)
+        METRICS.count("profiles_" + result)
+        if result == "failed":
+            failed += 1
+            continue
+        state[profile["ManagedUser"]] = userstate
+        plistfilepath = os.path.realpath(os.path.join(path, profile["ManagedUser"]))
+        if snapshotStale(plistfilepath):
+            try:
+                with METRICS.span("snapshot_compile"):
+                    compileSnapshot(plistfilepath)
+                logging.info("%s: Compiled snapshot", profile["ManagedUser"])
+            except (IOError, OSError, ExpatError) as err:
+                logging.error("%s: Can not compile snapshot: %s",
+                              profile["ManagedUser"], err)
+    with METRICS.span("state_write"):
+        writeState(statepath, state)
+    if failed:
+        logging.info("Not removing unused blobs as %d profiles failed", failed)
+        exit(1)
+    with METRICS.span("garbage_collect"):
+        collectGarbage(path, state)
 
 if __name__ == '__main__':
-    wait_for_internet_connection()
-    main()
+    PARSER = argparse.ArgumentParser(description="Downloads the plists for dock-maintainer.")
+    PARSER.add_argument("--rollback", metavar="USER",
+                        help="point USER back at the plist it used before the last update")
+    ARGS = PARSER.parse_args()
+    if ARGS.rollback:
+        STATEPATH = os.path.join(os.path.realpath(SUPPORT_PATH), ".updater-state.plist")
+        STATE = readState(STATEPATH)
+        if not rollback(os.path.realpath(SUPPORT_PATH), STATE, ARGS.rollback):
+            exit(1)
+        writeState(STATEPATH, STATE)
+    else:
+        METRICS.set(ExitCode=0)
+        try:
+            if os.environ.get(PROFILE_ENV):
+                runProfiled(os.environ[PROFILE_ENV], main)
+            else:
+                main()
+        except SystemExit as err:
+            METRICS.set(ExitCode=err.code)
+            raise
+        finally:
+            METRICS.write()
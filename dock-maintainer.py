@@ -1,32 +1,616 @@
 #!/usr/bin/python
 '''
 A wrapper for dockutil that manages a specified users dock with a server based plist for the list.
+
+After every successful run a fingerprint of the config, of the user's Dock
+plist and of the dock-maintainer preference files is saved. When none of them
+changed by the next login the run stops right there, before PyObjC is even
+imported.
 '''
+import time
+_START = time.time()
 import subprocess
 import plistlib
+import hashlib
+import pwd
 import os
 import logging
-from Foundation import kCFPreferencesCurrentHost, \
-                       CFPreferencesCopyAppValue, \
-                       CFPreferencesSetAppValue, \
-                       CFPreferencesSetMultiple, \
-                       kCFPreferencesCurrentUser, \
-                       CFPreferencesAppSynchronize, \
-                       NSURL
-
-from SystemConfiguration import SCDynamicStoreCopyConsoleUser
-
-logging.basicConfig(format='%(asctime)s - %(levelname)s: %(message)s',
-                    datefmt='%Y-%m-%d %I:%M:%S %p',
-                    level=logging.INFO,
-                    filename=os.path.expanduser('~/Library/Logs/dock-maintainer.log'))
-stdout_logging = logging.StreamHandler()
-stdout_logging.setFormatter(logging.Formatter())
-logging.getLogger().addHandler(stdout_logging)
+import logging.handlers
+import threading
+import Queue
+import atexit
+import urllib
+import json
+import sys
+import argparse
+import select
+import struct
+import stat
+import bisect
+from collections import OrderedDict
+from contextlib import contextmanager
+from xml.parsers.expat import ExpatError
+
+CONFIG_PATH = os.path.realpath(
+    "/Library/Application Support/com.github.wardsparadox.dock-maintainer/")
+FINGERPRINT_NAME = \
+    "Library/Application Support/com.github.wardsparadox.dock-maintainer/fingerprint.plist"
+FINGERPRINT_PATH = os.path.join(os.path.expanduser("~"), FINGERPRINT_NAME)
+METRICS_PATH = os.path.expanduser('~/Library/Logs/dock-maintainer-metrics.log')
+PROFILE_ENV = "DOCK_MAINTAINER_PROFILE"
+
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUPS = 5
+LOG_QUEUE_SIZE = 1000
+
+class GzipRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    '''
+    A RotatingFileHandler that gzips the files it rotates out, keeping
+    them as <log>.1.gz, the newest, up to <log>.<backupCount>.gz
+    '''
+    def doRollover(self):
+        import gzip
+        import shutil
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        for index in range(self.backupCount - 1, 0, -1):
+            source = "%s.%d.gz" % (self.baseFilename, index)
+            if os.path.exists(source):
+                os.rename(source, "%s.%d.gz" % (self.baseFilename, index + 1))
+        if os.path.exists(self.baseFilename):
+            with open(self.baseFilename, "rb") as source:
+                with gzip.open(self.baseFilename + ".1.gz", "wb") as target:
+                    shutil.copyfileobj(source, target)
+            os.remove(self.baseFilename)
+        if not self.delay:
+            self.stream = self._open()
+
+class LogWriter(threading.Thread):
+    '''
+    Hands queued log records to the real handlers on a background thread,
+    so logging only costs the caller a put on a bounded queue. Records
+    that find the queue full are dropped and counted instead of waited on.
+    '''
+    def __init__(self, handlers, maxsize=LOG_QUEUE_SIZE):
+        threading.Thread.__init__(self, name="LogWriter")
+        self.daemon = True
+        self.handlers = handlers
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, record):
+        '''queues record without ever blocking'''
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        '''writes out what is queued and closes the handlers'''
+        self.queue.put(None)
+        self.join()
+        if self.dropped:
+            record = logging.makeLogRecord(
+                {"levelno": logging.WARNING, "levelname": "WARNING",
+                 "msg": "Dropped %d log records, the log queue was full" % self.dropped})
+            for handler in self.handlers:
+                handler.handle(record)
+        for handler in self.handlers:
+            handler.close()
+
+class QueueHandler(logging.Handler):
+    '''
+    Passes records on to a LogWriter, with the message merged in first so
+    they no longer refer to arguments the caller may change
+    '''
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.writer.put(record)
+        except Exception:
+            self.handleError(record)
+
+def setupLogging(filename):
+    '''
+    Sends the root logger through a LogWriter to stdout and to filename,
+    rotated at LOG_MAX_BYTES with LOG_BACKUPS gzipped copies. The file is
+    only opened once the first record is written.
+    '''
+    file_logging = GzipRotatingFileHandler(filename, maxBytes=LOG_MAX_BYTES,
+                                           backupCount=LOG_BACKUPS, delay=True)
+    file_logging.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s: %(message)s',
+                                                datefmt='%Y-%m-%d %I:%M:%S %p'))
+    stdout_logging = logging.StreamHandler()
+    stdout_logging.setFormatter(logging.Formatter())
+    writer = LogWriter([file_logging, stdout_logging])
+    writer.start()
+    atexit.register(writer.stop)
+    logging.getLogger().addHandler(QueueHandler(writer))
+    logging.getLogger().setLevel(logging.INFO)
+    return writer
+
+def setLogLevel(level):
+    '''
+    Sets the log level from the LogLevel preference, a name such as DEBUG
+    or WARNING. Unset or unknown values leave it at INFO.
+    '''
+    if not level:
+        return
+    value = logging.getLevelName(str(level).upper())
+    if isinstance(value, int):
+        logging.getLogger().setLevel(value)
+    else:
+        logging.warning("Unknown LogLevel %s, logging at INFO", level)
+
+LOG_WRITER = setupLogging(os.path.expanduser('~/Library/Logs/dock-maintainer.log'))
 
 class DockError(Exception):
     '''Basic exception'''
-    pass
+
+class Metrics(object):
+    '''
+    Times the phases of a run and counts what it did, then appends both as
+    one JSON line to the metrics log for the log shipper to aggregate
+    '''
+    def __init__(self, started=None):
+        self.reset(started)
+
+    def reset(self, started=None):
+        '''forgets everything recorded and starts a new run'''
+        self.started = started or time.time()
+        self.phases = {}
+        self.counters = {}
+        self.fields = {}
+
+    def add(self, phase, seconds):
+        '''adds seconds to the time spent in phase'''
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    @contextmanager
+    def span(self, phase):
+        '''times the with block as part of phase'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - start)
+
+    def count(self, counter, amount=1):
+        '''adds amount to counter'''
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def set(self, **fields):
+        '''sets top level fields of the record'''
+        self.fields.update(fields)
+
+    def record(self):
+        '''returns the record of the run so far'''
+        record = {"Script": "dock-maintainer",
+                  "Host": os.uname()[1],
+                  "User": pwd.getpwuid(os.getuid()).pw_name,
+                  "Started": round(self.started, 3),
+                  "Seconds": round(time.time() - self.started, 4),
+                  "Phases": dict((phase, round(seconds, 4))
+                                 for phase, seconds in self.phases.items()),
+                  "Counters": self.counters}
+        record.update(self.fields)
+        return record
+
+    def write(self, path=METRICS_PATH):
+        '''appends the record to path and starts a new run'''
+        try:
+            with open(path, "a") as metricsfile:
+                metricsfile.write(json.dumps(self.record(), sort_keys=True) + "\n")
+        except (IOError, OSError) as err:
+            logging.warning("dock-maintainer: Could not write metrics: %s", err)
+        self.reset()
+
+METRICS = Metrics(_START)
+
+def runProfiled(statspath, func, *args):
+    '''
+    Calls func under cProfile and dumps the stats to statspath, for reading
+    with pstats, even when func exits
+    '''
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        profiler.dump_stats(statspath)
+        logging.info("dock-maintainer: Wrote profile to %s", statspath)
+
+def fileURL(thePath):
+    '''
+    Returns the file URL string for thePath the way NSURL builds it,
+    with a trailing slash for directories
+    '''
+    url = "file://" + urllib.pathname2url(os.path.abspath(thePath))
+    if os.path.isdir(thePath) and not url.endswith("/"):
+        url += "/"
+    return url
+
+class PreferencesBackend(object):
+    '''
+    Everything the maintainer needs from the system: reading and writing
+    preferences, building file URLs, finding the console user and
+    restarting the Dock. Subclasses supply the actual storage.
+    '''
+    def copyAppValue(self, key, domain):
+        '''returns the value of key in domain, or None'''
+        raise NotImplementedError
+
+    def setAppValues(self, values, domain):
+        '''stages all keys of the values dict in domain'''
+        raise NotImplementedError
+
+    def synchronize(self, domain):
+        '''writes staged values of domain out, returns True on success'''
+        raise NotImplementedError
+
+    def refresh(self, domain):
+        '''drops any cached values of domain so the next read is current'''
+        pass
+
+    def fileURL(self, thePath):
+        '''returns the file URL string for thePath'''
+        return fileURL(thePath)
+
+    def consoleUser(self):
+        '''returns the short name of the console user'''
+        return consoleUser()
+
+    def restartDock(self):
+        '''restarts the Dock so it picks up new preferences'''
+        raise NotImplementedError
+
+class FoundationBackend(PreferencesBackend):
+    '''
+    The real thing: CFPreferences, NSURL and launchd for the current user.
+    PyObjC is only imported when this backend is created.
+    '''
+    _DOCK_LAUNCHAGENT_ID = 'com.apple.Dock.agent'
+
+    def __init__(self):
+        import Foundation
+        self._foundation = Foundation
+
+    def copyAppValue(self, key, domain):
+        return self._foundation.CFPreferencesCopyAppValue(key, domain)
+
+    def setAppValues(self, values, domain):
+        self._foundation.CFPreferencesSetMultiple(
+            values, None, domain,
+            self._foundation.kCFPreferencesCurrentUser,
+            self._foundation.kCFPreferencesAnyHost)
+
+    def synchronize(self, domain):
+        return self._foundation.CFPreferencesAppSynchronize(domain)
+
+    def refresh(self, domain):
+        self._foundation.CFPreferencesAppSynchronize(domain)
+
+    def fileURL(self, thePath):
+        return self._foundation.NSURL.fileURLWithPath_(thePath).absoluteString()
+
+    def restartDock(self):
+        subprocess.call(['/bin/launchctl', 'kickstart', '-k',
+                         'gui/%d/%s' % (os.getuid(), self._DOCK_LAUNCHAGENT_ID)])
+
+class PlistFileBackend(PreferencesBackend):
+    '''
+    Preferences kept as <domain>.plist files in one folder, read and
+    written with plistlib, so it works off a Mac and on offline homes.
+    Files written are given to owner, a (uid, gid) tuple, if set.
+    Dock restarts are only counted.
+    '''
+    def __init__(self, prefsdir, username="", owner=None):
+        self.prefsdir = prefsdir
+        self.username = username
+        self.owner = owner
+        self.restarts = 0
+        self._domains = {}
+
+    def _domain(self, domain):
+        if domain not in self._domains:
+            path = os.path.join(self.prefsdir, domain + ".plist")
+            try:
+                self._domains[domain] = plistlib.readPlist(path)
+            except IOError:
+                self._domains[domain] = {}
+            except ExpatError:
+                # cfprefsd writes binary plists, which plistlib can not read
+                self._domains[domain] = plistlib.readPlistFromString(
+                    subprocess.check_output(["plutil", "-convert", "xml1",
+                                             "-o", "-", path]))
+        return self._domains[domain]
+
+    def copyAppValue(self, key, domain):
+        return self._domain(domain).get(key)
+
+    def setAppValues(self, values, domain):
+        self._domain(domain).update(values)
+
+    def synchronize(self, domain):
+        path = os.path.join(self.prefsdir, domain + ".plist")
+        temppath = path + ".tmp"
+        plistlib.writePlist(self._domain(domain), temppath)
+        if self.owner:
+            os.chown(temppath, *self.owner)
+        os.rename(temppath, path)
+        return True
+
+    def refresh(self, domain):
+        self._domains.pop(domain, None)
+
+    def consoleUser(self):
+        return self.username
+
+    def restartDock(self):
+        self.restarts += 1
+
+class MemoryBackend(PreferencesBackend):
+    '''
+    Preferences held in a dict of domains, for measuring the maintainer
+    without touching any file. Dock restarts are only counted.
+    '''
+    def __init__(self, domains=None, username=""):
+        self.domains = domains or {}
+        self.username = username
+        self.restarts = 0
+        self.synchronized = 0
+
+    def copyAppValue(self, key, domain):
+        return self.domains.get(domain, {}).get(key)
+
+    def setAppValues(self, values, domain):
+        self.domains.setdefault(domain, {}).update(values)
+
+    def synchronize(self, domain):
+        self.synchronized += 1
+        return True
+
+    def consoleUser(self):
+        return self.username
+
+    def restartDock(self):
+        self.restarts += 1
+
+class Tile(object):
+    '''
+    A Dock tile reduced to what the maintainer looks at: its label, URL
+    string, tile-type and the display options of its tile-data. A tile
+    read from the Dock keeps the item it came from and hands that back
+    untouched, GUID and unknown keys included, so only tiles built here
+    are turned into dictionaries, when their section is written. Tiles
+    are never changed once made and can be shared.
+    '''
+    __slots__ = ('label', 'url', 'kind', 'options', 'source')
+
+    def __init__(self, label, url, kind='file-tile', options=(), source=None):
+        self.label = label
+        self.url = url
+        self.kind = kind
+        self.options = options
+        self.source = source
+
+    @classmethod
+    def fromItem(cls, item):
+        '''returns the Tile for a Dock item as stored in the preferences'''
+        data = item.get('tile-data') or {}
+        return cls(data.get('file-label'),
+                   (data.get('file-data') or {}).get('_CFURLString'),
+                   item.get('tile-type'), (), item)
+
+    def toItem(self):
+        '''returns the Dock item for the tile'''
+        if self.source is not None:
+            return self.source
+        data = dict(self.options)
+        data['file-data'] = {'_CFURLString': self.url, '_CFURLStringType': 15}
+        data['file-label'] = self.label
+        return {'tile-data': data, 'tile-type': self.kind}
+
+    def __repr__(self):
+        return "Tile(%r, %r)" % (self.label, self.url)
+
+class TileFactory(object):
+    '''
+    Hands out Dock tiles from a bounded LRU keyed on the target path, its
+    mtime and whether it is a folder, plus the section and display
+    options. A tile is dropped as soon as its target is seen with a
+    different stat. Tiles are immutable, so callers share the cached one.
+    Only --watch keeps one across reconciles; a one-shot run would pay a
+    stat per tile for a cache that is thrown away before it can hit.
+    '''
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+        self._keys = {}
+
+    def get(self, thePath, options, build):
+        '''returns the tile for thePath and options, calling build(thePath)
+            to make it when it is not cached'''
+        try:
+            info = os.stat(thePath)
+            stamp = (info.st_mtime, stat.S_ISDIR(info.st_mode))
+        except OSError:
+            stamp = None
+        key = (thePath, stamp) + tuple(options)
+        stale = self._keys.get((thePath,) + tuple(options))
+        if stale is not None and stale != key:
+            self._templates.pop(stale, None)
+        template = self._templates.pop(key, None)
+        if template is None:
+            self.misses += 1
+            with METRICS.span("tile_build"):
+                template = build(thePath)
+        else:
+            self.hits += 1
+        self._templates[key] = template
+        self._keys[(thePath,) + tuple(options)] = key
+        if len(self._templates) > self.maxsize:
+            oldest = self._templates.popitem(last=False)[0]
+            self._keys.pop((oldest[0],) + oldest[2:], None)
+        return template
+
+class ExistenceScan(object):
+    '''
+    Tells whether Dock targets exist from listings of the folders holding
+    them, so a config with many apps in /Applications costs one stat and
+    at most one listing of the folder instead of a stat per app. Listings
+    are kept with the folder's mtime and only redone when that moved.
+    They can be saved with listings() and handed to the next run.
+    '''
+    def __init__(self, folders=None):
+        self.folders = dict(folders or {})
+        self.listed = 0
+        self._names = {}
+        self._used = set()
+
+    def exists(self, thePath):
+        '''returns True if thePath is in the listing of its folder. A name
+            the listing lacks is looked up on disk, as the volume may not
+            care about case or may store the name in another Unicode form.'''
+        folder, name = os.path.split(os.path.normpath(thePath))
+        self._used.add(folder)
+        names = self._listing(folder)
+        if names is None:
+            return False
+        return name in names or os.path.exists(thePath)
+
+    def _listing(self, folder):
+        '''returns the set of names in folder, or None when it can not be
+            read, looking at each folder once per scan'''
+        if folder in self._names:
+            return self._names[folder]
+        self._names[folder] = None
+        try:
+            mtime = os.stat(folder).st_mtime
+        except OSError:
+            self.folders.pop(folder, None)
+            return None
+        entry = self.folders.get(folder)
+        if entry is None or entry["MTime"] != mtime:
+            try:
+                names = sorted(os.listdir(folder))
+            except OSError:
+                return None
+            entry = {"MTime": mtime, "Names": names}
+            self.folders[folder] = entry
+            self.listed += 1
+        self._names[folder] = set(entry["Names"])
+        return self._names[folder]
+
+    def missing(self, paths):
+        '''returns the set of paths that do not exist'''
+        return set(thePath for thePath in paths if not self.exists(thePath))
+
+    def listings(self):
+        '''returns the MTime and Names of the folders looked at, by folder'''
+        return dict((folder, entry) for folder, entry in self.folders.items()
+                    if folder in self._used)
+
+MISSING_POLICIES = ("add", "skip", "defer")
+
+def presentEntries(entries, paths, present, missing, policy):
+    '''
+    Returns the config entries to put in a Dock section given the missing
+    paths, paths being the target of each entry and present the labels
+    already in the section. Missing targets are added anyway with the
+    add policy and left out with skip. With defer, the default, they are
+    left out unless already in the Dock, where they stay until they are
+    back or gone from the config, so an app being reinstalled is not
+    removed and added again.
+    '''
+    if policy == "add":
+        return entries, paths
+    kept = [(entry, thePath) for entry, thePath in zip(entries, paths)
+            if thePath not in missing or
+            (policy == "defer" and entry["Label"] in present)]
+    return [entry for entry, _ in kept], [thePath for _, thePath in kept]
+
+class SectionIndex(object):
+    '''
+    Maps the labels and URL strings of the tiles of a Dock section to their
+    positions. Tiles are filed under the slot they had when the index was
+    built and removed slots are kept in a sorted list, so the position of a
+    slot is found by counting the removed slots before it and a removal
+    costs a bisect instead of renumbering every later tile. Like a linear
+    scan, the first of several duplicate tiles wins.
+    '''
+    def __init__(self, items):
+        self.labels = {}
+        self.urls = {}
+        self.removed = []
+        for slot, item in enumerate(items):
+            self.labels.setdefault(item.label, []).append(slot)
+            self.urls.setdefault(item.url, []).append(slot)
+
+    def _position(self, slot):
+        '''returns the current position of slot'''
+        return slot - bisect.bisect_left(self.removed, slot)
+
+    def _slot(self, position):
+        '''returns the slot of the tile now at position'''
+        slot = position
+        while True:
+            moved = position + bisect.bisect_right(self.removed, slot)
+            if moved == slot:
+                return slot
+            slot = moved
+
+    def find(self, lookup, key):
+        '''returns the position of the first tile filed under key in
+            lookup, labels or urls, or -1'''
+        slots = lookup.get(key)
+        if not slots:
+            return -1
+        return self._position(slots[0])
+
+    def remove(self, position, item):
+        '''forgets item, which was at position'''
+        slot = self._slot(position)
+        for lookup, key in ((self.labels, item.label), (self.urls, item.url)):
+            self._unfile(lookup, key, slot)
+        bisect.insort(self.removed, slot)
+
+    def replace(self, position, old_item, new_item):
+        '''files new_item, which took the place of old_item at position'''
+        slot = self._slot(position)
+        for lookup, old_key, new_key in ((self.labels, old_item.label, new_item.label),
+                                         (self.urls, old_item.url, new_item.url)):
+            if old_key != new_key:
+                self._unfile(lookup, old_key, slot)
+                bisect.insort(lookup.setdefault(new_key, []), slot)
+
+    @staticmethod
+    def _unfile(lookup, key, slot):
+        '''removes slot from the slots filed under key'''
+        slots = lookup[key]
+        slots.remove(slot)
+        if not slots:
+            del lookup[key]
 
 class Dock():
     '''Class to handle Dock operations'''
@@ -36,42 +620,53 @@ class Dock():
     _DOCK_LAUNCHAGENT_ID = 'com.apple.Dock.agent'
     _DOCK_LAUNCHAGENT_FILE = '/System/Library/LaunchAgents/com.apple.Dock.plist'
     _SECTIONS = ['persistent-apps', 'persistent-others']
-    items = {}
 
-    def __init__(self):
-        for key in self._SECTIONS:
-            try:
-                section = CFPreferencesCopyAppValue(key, self._DOMAIN)
-                self.items[key] = section.mutableCopy()
-            except Exception:
-                raise
-
-    def save(self):
-        '''saves our (modified) Dock preferences'''
-        # unload Dock launchd job so we can make our changes unmolested
-        subprocess.call(
-            ['/bin/launchctl', 'unload', self._DOCK_LAUNCHAGENT_FILE])
-
-        for key in self._SECTIONS:
-            try:
-                CFPreferencesSetAppValue(key, self.items[key], self._DOMAIN)
-            except Exception:
-                raise DockError
-        if not CFPreferencesAppSynchronize(self._DOMAIN):
-            raise DockError
+    def __init__(self, backend, tiles=None):
+        self.backend = backend
+        self.tiles = tiles
+        self.items = {}
+        self.changed = set()
+        self._index = {}
+        with METRICS.span("dock_load"):
+            backend.refresh(self._DOMAIN)
+            for key in self._SECTIONS:
+                self.items[key] = [Tile.fromItem(item) for item in
+                                   backend.copyAppValue(key, self._DOMAIN) or []]
 
-        # restart the Dock
-        subprocess.call(['/bin/launchctl', 'load', self._DOCK_LAUNCHAGENT_FILE])
-        subprocess.call(['/bin/launchctl', 'start', self._DOCK_LAUNCHAGENT_ID])
+    def save(self, preferences=None):
+        '''saves our (modified) Dock sections together with preferences,
+            if given, and restarts the Dock once. Returns False without
+            touching anything when nothing differs from what is set.'''
+        commit = DockCommit(self)
+        if preferences:
+            commit.stagePreferences(preferences)
+        return commit.commit()
+
+    def setSection(self, section, items):
+        '''replaces the whole contents of section'''
+        self.items[section] = items
+        self.changed.add(section)
+        self._index.pop(section, None)
+
+    def _sectionIndex(self, section):
+        '''returns the SectionIndex of section, built once and kept
+            across removals and replacements until the section is
+            replaced as a whole'''
+        if section not in self._index:
+            self._index[section] = SectionIndex(self.items[section])
+        return self._index[section]
 
     def findExistingLabel(self, test_label, section='persistent-apps'):
         '''returns index of item with label matching test_label
             or -1 if not found'''
-        for index in range(len(self.items[section])):
-            if (self.items[section][index]['tile-data'].get('file-label') ==
-                    test_label):
-                return index
-        return -1
+        index = self._sectionIndex(section)
+        return index.find(index.labels, test_label)
+
+    def findExistingURL(self, test_url, section='persistent-apps'):
+        '''returns index of item with URL string matching test_url
+            or -1 if not found'''
+        index = self._sectionIndex(section)
+        return index.find(index.urls, test_url)
 
     def removeDockEntry(self, label, section=None):
         '''Removes a Dock entry with matching label, if any'''
@@ -82,36 +677,178 @@ class Dock():
         for section in sections:
             found_index = self.findExistingLabel(label, section=section)
             if found_index > -1:
-                del self.items[section][found_index]
+                item = self.items[section].pop(found_index)
+                self.changed.add(section)
+                self._sectionIndex(section).remove(found_index, item)
 
     def replaceDockEntry(self, thePath, label=None, section='persistent-apps'):
         '''Replaces a Dock entry. If label is None, then a label is derived
             from the item path. The new entry replaces an entry with the given
             or derived label'''
-        if section == 'persistent-apps':
-            new_item = self.makeDockAppEntry(thePath)
-        else:
-            new_item = self.makeDockOtherEntry(thePath)
+        new_item = self.makeDockEntry(thePath, section)
         if new_item:
             if not label:
                 label = os.path.splitext(os.path.basename(thePath))[0]
             found_index = self.findExistingLabel(label, section=section)
             if found_index > -1:
+                old_item = self.items[section][found_index]
                 self.items[section][found_index] = new_item
+                self.changed.add(section)
+                self._sectionIndex(section).replace(found_index, old_item, new_item)
+
+    def applyEdits(self, edits, section='persistent-apps'):
+        '''Applies a list of edits to section in a single pass. Each edit is
+            one of ('add', path), ('remove', label) or
+            ('replace', path, label), where label may be None to derive it
+            from path. Removes win over replaces of the same item and adds
+            are appended in order. section is left alone when no edit
+            matched.'''
+        removed = set()
+        replaced = {}
+        added = []
+        for edit in edits:
+            if edit[0] == 'add':
+                new_item = self.makeDockEntry(edit[1], section)
+                if new_item:
+                    added.append(new_item)
+            elif edit[0] == 'remove':
+                index = self.findExistingLabel(edit[1], section)
+                if index > -1:
+                    removed.add(index)
+            elif edit[0] == 'replace':
+                label = edit[2] or os.path.splitext(os.path.basename(edit[1]))[0]
+                index = self.findExistingLabel(label, section)
+                if index > -1:
+                    new_item = self.makeDockEntry(edit[1], section)
+                    if new_item:
+                        replaced[index] = new_item
+            else:
+                raise DockError("Unknown edit %r" % (edit,))
+        if not (removed or replaced or added):
+            return
+        items = [replaced.get(index, item)
+                 for index, item in enumerate(self.items[section])
+                 if index not in removed]
+        self.setSection(section, items + added)
+
+    def reconcileSection(self, section, paths, makeEntry, labels=None):
+        '''Brings section in line with the list of paths, building missing
+            tiles with makeEntry. Tiles that are already present are kept
+            as they are, GUIDs and extra keys included. labels are derived
+            from paths unless given. Returns the edit script that was
+            applied, empty when nothing changed.'''
+        desired = labels or [os.path.splitext(os.path.basename(thePath))[0]
+                             for thePath in paths]
+        script, items = self._arrange(self.items[section], paths, makeEntry, desired)
+        if script:
+            self.setSection(section, items)
+        return script
+
+    def mergeSection(self, section, paths, makeEntry, labels=None):
+        '''Like reconcileSection, but only requires the tiles for paths to
+            be in section in the order given, leaving any other tile the
+            user added where it is. That is checked in one pass, and only
+            when it fails are the config's tiles put in order in the slots
+            they hold, with new ones after the last of them. Returns the
+            edit script applied to the config's tiles, empty when nothing
+            changed.'''
+        current = self.items[section]
+        desired = labels or [os.path.splitext(os.path.basename(thePath))[0]
+                             for thePath in paths]
+        position = 0
+        for item in current:
+            if position < len(desired) and item.label == desired[position]:
+                position += 1
+        if position == len(desired):
+            return []
+        wanted = set(desired)
+        slots = [index for index, item in enumerate(current)
+                 if item.label in wanted]
+        script, managed = self._arrange([current[index] for index in slots],
+                                        paths, makeEntry, desired)
+        managed = iter(managed)
+        taken = set(slots)
+        items = []
+        for index, item in enumerate(current):
+            if index not in taken:
+                items.append(item)
+                continue
+            for tile in managed:
+                items.append(tile)
+                break
+            if index == slots[-1]:
+                items.extend(managed)
+        if not slots:
+            items.extend(managed)
+        self.setSection(section, items)
+        return script
+
+    def _arrange(self, current, paths, makeEntry, desired):
+        '''returns the edit script turning the tiles in current into the
+            tiles for paths, labelled desired, and the resulting tiles'''
+        with METRICS.span("diff"):
+            script = diffLabels([item.label for item in current], desired)
+        if not script:
+            return script, current
+        moved = {}
+        inserted = set()
+        dropped = set()
+        for edit in script:
+            if edit[0] == 'move':
+                moved[edit[3]] = edit[2]
+                dropped.add(edit[2])
+            elif edit[0] == 'insert':
+                inserted.add(edit[2])
+            else:
+                dropped.add(edit[2])
+        # kept items keep their relative order, so they fill the remaining
+        # slots in sequence
+        kept = iter([item for index, item in enumerate(current)
+                     if index not in dropped])
+        items = []
+        for index, thePath in enumerate(paths):
+            if index in moved:
+                items.append(current[moved[index]])
+            elif index in inserted:
+                items.append(makeEntry(thePath))
+            else:
+                items.append(next(kept))
+        return script, items
+
+    def makeDockEntry(self, thePath, section='persistent-apps'):
+        '''returns a dictionary for thePath suited to section'''
+        if section == 'persistent-apps':
+            return self.makeDockAppEntry(thePath)
+        return self.makeDockOtherEntry(thePath)
 
     def makeDockAppEntry(self, thePath):
-        '''returns a dictionary corresponding to a Dock application item'''
+        '''returns a Tile corresponding to a Dock application item'''
+        return self._tile(thePath, ('persistent-apps',), self._buildDockAppEntry)
+
+    def _buildDockAppEntry(self, thePath):
+        '''builds the Tile returned by makeDockAppEntry'''
         label_name = os.path.splitext(os.path.basename(thePath))[0]
-        ns_url = NSURL.fileURLWithPath_(thePath).absoluteString()
-        return {'tile-data': {'file-data': {'_CFURLString': ns_url,
-                                            '_CFURLStringType': 15},
-                              'file-label': label_name,
-                              'file-type': 41},
-                'tile-type': 'file-tile'}
+        ns_url = self.backend.fileURL(thePath)
+        return Tile(label_name, ns_url, 'file-tile', (('file-type', 41),))
 
     def makeDockOtherEntry(self, thePath,
                            arrangement=0, displayas=1, showas=0):
-        '''returns a dictionary corresponding to a Dock folder or file item'''
+        '''returns a Tile corresponding to a Dock folder or file item'''
+        return self._tile(
+            thePath, ('persistent-others', arrangement, displayas, showas),
+            lambda path: self._buildDockOtherEntry(path, arrangement,
+                                                   displayas, showas))
+
+    def _tile(self, thePath, options, build):
+        '''returns the tile for thePath from the TileFactory, if the Dock
+            was given one, or else from build(thePath)'''
+        if self.tiles is not None:
+            return self.tiles.get(thePath, options, build)
+        with METRICS.span("tile_build"):
+            return build(thePath)
+
+    def _buildDockOtherEntry(self, thePath, arrangement, displayas, showas):
+        '''builds the Tile returned by makeDockOtherEntry'''
         # arrangement values:
         #     1: sort by name
         #     2: sort by date added
@@ -137,29 +874,442 @@ class Dock():
             else:
                 # set to sort by name
                 arrangement = 1
-        ns_url = NSURL.fileURLWithPath_(thePath).absoluteString()
+        ns_url = self.backend.fileURL(thePath)
         if os.path.isdir(thePath):
-            return {'tile-data':{'arrangement': arrangement,
-                                 'displayas': displayas,
-                                 'file-data':{'_CFURLString': ns_url,
-                                              '_CFURLStringType': 15},
-                                 'file-label': label_name,
-                                 'dock-extra': False,
-                                 'showas': showas
-                                },
-                    'tile-type':'directory-tile'}
+            return Tile(label_name, ns_url, 'directory-tile',
+                        (('arrangement', arrangement),
+                         ('displayas', displayas),
+                         ('dock-extra', False),
+                         ('showas', showas)))
         else:
-            return {'tile-data':{'file-data':{'_CFURLString': ns_url,
-                                              '_CFURLStringType': 15},
-                                 'file-label': label_name,
-                                 'dock-extra': False},
-                    'tile-type':'file-tile'}
+            return Tile(label_name, ns_url, 'file-tile', (('dock-extra', False),))
+
+class DockCommit(object):
+    '''
+    Collects changed Dock sections and preference keys and writes them in
+    one transaction: a single write of all keys, a single synchronize and
+    a single Dock restart.
+    '''
+    def __init__(self, dock):
+        self.dock = dock
+        self.preferences = {}
+        self.timings = {}
 
-dock = Dock()
+    def stagePreferences(self, preferences):
+        '''adds Dock preference keys to write with the sections'''
+        self.preferences.update(preferences)
 
-def setPreferences():
+    def changes(self):
+        '''returns the staged keys whose values differ from what is set'''
+        changes = {}
+        for section in self.dock.changed:
+            items = [tile.toItem() for tile in self.dock.items[section]]
+            if list(self.dock.backend.copyAppValue(section, self.dock._DOMAIN) or []) != items:
+                changes[section] = items
+        for key, value in self.preferences.items():
+            if self.dock.backend.copyAppValue(key, self.dock._DOMAIN) != value:
+                changes[key] = value
+        return changes
+
+    def commit(self):
+        '''writes the changes, if any, and restarts the Dock once.
+            Returns True when something was written.'''
+        start = time.time()
+        changes = self.changes()
+        self.timings["diff"] = time.time() - start
+        if not changes:
+            logging.info("dock-maintainer: Nothing staged differs, not committing")
+            self.dock.changed.clear()
+            return False
+        start = time.time()
+        self.dock.backend.setAppValues(changes, self.dock._DOMAIN)
+        self.timings["write"] = time.time() - start
+        start = time.time()
+        if not self.dock.backend.synchronize(self.dock._DOMAIN):
+            raise DockError("Could not synchronize %s" % self.dock._DOMAIN)
+        self.timings["sync"] = time.time() - start
+        start = time.time()
+        self.dock.backend.restartDock()
+        self.timings["restart"] = time.time() - start
+        self.dock.changed.clear()
+        for stage, phase in (("diff", "commit_diff"), ("write", "preference_write"),
+                             ("sync", "preference_sync"), ("restart", "dock_restart")):
+            METRICS.add(phase, self.timings[stage])
+        logging.info("dock-maintainer: Committed %s in %s", sorted(changes.keys()),
+                     ", ".join("%s %.3fs" % (stage, self.timings[stage])
+                               for stage in ("diff", "write", "sync", "restart")))
+        return True
+
+def diffLabels(current, desired):
+    '''
+    Returns the edit script turning the list of labels current into desired
+    while keeping their longest common subsequence in place. Entries are
+    ('move', label, old_index, new_index), ('insert', label, new_index) or
+    ('delete', label, old_index). Labels that stay put are not listed.
+    '''
+    # lengths[i][j] is the LCS length of current[i:] and desired[j:]
+    lengths = [[0] * (len(desired) + 1) for _ in range(len(current) + 1)]
+    for i in range(len(current) - 1, -1, -1):
+        for j in range(len(desired) - 1, -1, -1):
+            if current[i] == desired[j]:
+                lengths[i][j] = lengths[i + 1][j + 1] + 1
+            else:
+                lengths[i][j] = max(lengths[i + 1][j], lengths[i][j + 1])
+    kept_old = set()
+    kept_new = set()
+    i = j = 0
+    while i < len(current) and j < len(desired):
+        if current[i] == desired[j]:
+            kept_old.add(i)
+            kept_new.add(j)
+            i += 1
+            j += 1
+        elif lengths[i + 1][j] >= lengths[i][j + 1]:
+            i += 1
+        else:
+            j += 1
+    spare = {}
+    for i, label in enumerate(current):
+        if i not in kept_old:
+            spare.setdefault(label, []).append(i)
+    script = []
+    for j, label in enumerate(desired):
+        if j in kept_new:
+            continue
+        if spare.get(label):
+            script.append(('move', label, spare[label].pop(0), j))
+        else:
+            script.append(('insert', label, j))
+    deletes = [('delete', label, i)
+               for label, indices in spare.items() for i in indices]
+    return script + sorted(deletes, key=lambda edit: edit[2])
+
+def hashFile(path):
+    '''
+    Returns the SHA-256 hex digest of the file at path
+    '''
+    digest = hashlib.sha256()
+    with open(path, "rb") as contents:
+        for chunk in iter(lambda: contents.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def configFilePath():
+    '''
+    Returns the path of the config for the user running this. The agent only
+    acts when that user is the ManagedUser, so this is the config it applies.
+    '''
+    return os.path.join(CONFIG_PATH, pwd.getpwuid(os.getuid()).pw_name)
+
+def preferenceStamps(user=None):
+    '''
+    Returns the mtime and size of every plist the dock-maintainer
+    preferences of user, a pwd entry or else the current user, can come
+    from, by path. Settings like LockDock change what a run does, so the
+    fingerprint keeps these to tell when they moved, without loading
+    PyObjC to read them.
+    '''
+    if user:
+        username, home = user.pw_name, user.pw_dir
+    else:
+        username, home = pwd.getpwuid(os.getuid()).pw_name, os.path.expanduser("~")
+    name = "com.github.wardsparadox.dock-maintainer.plist"
+    stamps = {}
+    for thePath in (os.path.join("/Library/Managed Preferences", username, name),
+                    os.path.join("/Library/Managed Preferences", name),
+                    os.path.join(home, "Library", "Preferences", name),
+                    os.path.join("/Library/Preferences", name)):
+        try:
+            info = os.stat(thePath)
+        except OSError:
+            continue
+        stamps[thePath] = [info.st_mtime, info.st_size]
+    return stamps
+
+def saveFingerprint(reconcile_seconds, folders=None, missing=(), user=None):
     '''
-    Sets dock preferences to keep dock as is.
+    Records the config, the Dock plist and the preference files as they
+    are after a successful run, with the folder listings of the
+    ExistenceScan and the mtimes of the folders that should hold the
+    missing paths. user, a pwd entry, saves it in that user's home and
+    owned by them instead of the current one's.
+    '''
+    if user:
+        configpath = os.path.join(CONFIG_PATH, user.pw_name)
+        dockplist = os.path.join(user.pw_dir, "Library", "Preferences",
+                                 Dock._DOMAIN + ".plist")
+        fingerprintpath = os.path.join(user.pw_dir, FINGERPRINT_NAME)
+    else:
+        configpath = configFilePath()
+        dockplist = Dock._DOCK_PLIST
+        fingerprintpath = FINGERPRINT_PATH
+    dockstat = os.stat(dockplist)
+    fingerprint = {"ConfigPath": configpath,
+                   "ConfigSHA256": hashFile(configpath),
+                   "DockMTime": dockstat.st_mtime,
+                   "DockSize": dockstat.st_size,
+                   "DockSHA256": hashFile(dockplist),
+                   "ReconcileSeconds": reconcile_seconds,
+                   "Preferences": preferenceStamps(user),
+                   "Folders": folders or {},
+                   "PendingFolders": dict(
+                       (os.path.dirname(thePath), folders[os.path.dirname(thePath)]["MTime"])
+                       for thePath in missing if os.path.dirname(thePath) in (folders or {}))}
+    folder = os.path.dirname(fingerprintpath)
+    created = []
+    while not os.path.isdir(folder):
+        created.insert(0, folder)
+        folder = os.path.dirname(folder)
+    for folder in created:
+        os.mkdir(folder)
+        if user:
+            os.chown(folder, user.pw_uid, user.pw_gid)
+    temppath = fingerprintpath + ".tmp"
+    plistlib.writePlist(fingerprint, temppath)
+    if user:
+        os.chown(temppath, user.pw_uid, user.pw_gid)
+    os.rename(temppath, fingerprintpath)
+
+def fingerprintMatches():
+    '''
+    Returns the saved fingerprint if neither the config, the Dock plist,
+    the preference files nor a folder that should hold a missing target
+    changed since it was saved, else None. The Dock plist is only hashed
+    when its mtime or size moved.
+    '''
+    try:
+        fingerprint = plistlib.readPlist(FINGERPRINT_PATH)
+        if (fingerprint["ConfigPath"] != configFilePath() or
+                fingerprint["ConfigSHA256"] != hashFile(configFilePath())):
+            return None
+        if fingerprint["Preferences"] != preferenceStamps():
+            return None
+        for folder, mtime in fingerprint.get("PendingFolders", {}).items():
+            if os.stat(folder).st_mtime != mtime:
+                return None
+        dockstat = os.stat(Dock._DOCK_PLIST)
+        if (dockstat.st_mtime == fingerprint["DockMTime"] and
+                dockstat.st_size == fingerprint["DockSize"]):
+            return fingerprint
+        if hashFile(Dock._DOCK_PLIST) == fingerprint["DockSHA256"]:
+            return fingerprint
+    except (IOError, OSError, KeyError, ExpatError):
+        pass
+    return None
+
+def savedFolders(home=None):
+    '''
+    Returns the folder listings saved with the last fingerprint in home,
+    the current user's by default
+    '''
+    fingerprintpath = os.path.join(home, FINGERPRINT_NAME) if home else FINGERPRINT_PATH
+    try:
+        return plistlib.readPlist(fingerprintpath).get("Folders", {})
+    except (IOError, ExpatError):
+        return {}
+
+class FileWatcher(object):
+    '''
+    Waits for changes to a set of files. The folders holding them are
+    watched, as preferences and configs are replaced by renames rather
+    than written in place.
+    '''
+    def __init__(self, paths):
+        self.paths = [os.path.abspath(thePath) for thePath in paths]
+        self.folders = sorted(set(os.path.dirname(thePath) for thePath in self.paths))
+        self._stamps = self._stat()
+
+    def _stat(self):
+        '''returns the inode, mtime and size of each file, None when missing'''
+        stamps = []
+        for thePath in self.paths:
+            try:
+                info = os.stat(thePath)
+                stamps.append((info.st_ino, info.st_mtime, info.st_size))
+            except OSError:
+                stamps.append(None)
+        return stamps
+
+    def changed(self):
+        '''returns True if a file was replaced or changed since the watcher
+            was made or this last returned True'''
+        stamps = self._stat()
+        if stamps != self._stamps:
+            self._stamps = stamps
+            return True
+        return False
+
+    def wait(self, timeout=None):
+        '''blocks until a watched file changes or timeout seconds pass,
+            forever when timeout is None. Returns True on a change.'''
+        raise NotImplementedError
+
+class KqueueWatcher(FileWatcher):
+    '''
+    Watches the folders with kqueue vnode events, used on macOS. The events
+    do not say which entry changed, so after each the files are compared by
+    stat, and the steady rewrites of other apps' preferences next to the
+    Dock plist are waited through rather than counted.
+    '''
+    # open for event notification only, so the volume can still unmount
+    O_EVTONLY = 0x8000
+
+    def __init__(self, paths):
+        FileWatcher.__init__(self, paths)
+        self._kqueue = select.kqueue()
+        self._fds = [os.open(folder, self.O_EVTONLY) for folder in self.folders]
+        self._events = [select.kevent(fd, filter=select.KQ_FILTER_VNODE,
+                                      flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+                                      fflags=select.KQ_NOTE_WRITE |
+                                      select.KQ_NOTE_DELETE |
+                                      select.KQ_NOTE_RENAME)
+                        for fd in self._fds]
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            if not self._kqueue.control(self._events, 1, remaining):
+                return False
+            if self.changed():
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+
+class InotifyWatcher(FileWatcher):
+    '''
+    Watches the folders with inotify through ctypes, used on Linux. Only
+    events naming one of the watched files count.
+    '''
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, paths):
+        FileWatcher.__init__(self, paths)
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self._folders = {}
+        for folder in self.folders:
+            wd = libc.inotify_add_watch(self._fd, folder,
+                                        self.IN_MODIFY | self.IN_CLOSE_WRITE |
+                                        self.IN_MOVED_TO | self.IN_CREATE |
+                                        self.IN_DELETE)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed", folder)
+            self._folders[wd] = folder
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            if not select.select([self._fd], [], [], remaining)[0]:
+                return False
+            data = os.read(self._fd, 64 * 1024)
+            changed = False
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = self._EVENT.unpack_from(data, offset)
+                offset += self._EVENT.size
+                name = data[offset:offset + length].rstrip("\0")
+                offset += length
+                if os.path.join(self._folders.get(wd, ""), name) in self.paths:
+                    changed = True
+            if changed:
+                return True
+
+class PollingWatcher(FileWatcher):
+    '''
+    Compares the stat of the files every interval seconds, for systems
+    with neither kqueue nor inotify
+    '''
+    def __init__(self, paths, interval=5.0):
+        FileWatcher.__init__(self, paths)
+        self.interval = interval
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if self.changed():
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+            if deadline is None:
+                time.sleep(self.interval)
+            else:
+                time.sleep(max(0, min(self.interval, deadline - time.time())))
+
+def makeWatcher(paths):
+    '''
+    Returns the best FileWatcher this system supports for paths
+    '''
+    if hasattr(select, "kqueue"):
+        return KqueueWatcher(paths)
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(paths)
+
+SNAPSHOT_VERSION = 2
+
+def loadConfig(configFile):
+    '''
+    Returns the config as a dict with Apps and Others lists of entries with
+    Path and Label, app entries from a snapshot also carrying a prebuilt
+    Tile, and Merge, True when the config only asks for its items to be
+    in the Dock in order next to the user's own. configFile links to a
+    blob in the updater's store, and the snapshot compiled next to that
+    blob is used when it matches the blob's size and mtime, otherwise the
+    plist is parsed.
+    '''
+    try:
+        with open(os.path.realpath(configFile) + ".snapshot") as snapshotfile:
+            snapshot = json.load(snapshotfile)
+        info = os.stat(configFile)
+        if (snapshot.get("Version") == SNAPSHOT_VERSION and
+                snapshot.get("SourceSize") == info.st_size and
+                snapshot.get("SourceMTime") == info.st_mtime):
+            METRICS.set(ConfigSource="snapshot")
+            return snapshot
+        logging.info("dock-maintainer: Snapshot is stale, reading plist")
+    except (IOError, OSError, ValueError):
+        pass
+    with METRICS.span("plist_parse"):
+        configPlist = plistlib.readPlist(configFile)
+    METRICS.set(ConfigSource="plist")
+    config = {"Apps": [], "Others": [], "Merge": bool(configPlist.get("Merge"))}
+    for key in ("Apps", "Others"):
+        for thePath in configPlist[key]:
+            thePath = os.path.normpath(thePath)
+            config[key].append(
+                {"Path": thePath,
+                 "Label": os.path.splitext(os.path.basename(thePath))[0]})
+    return config
+
+def consoleUser():
+    '''
+    Returns the short name of the user owning the console, or "" at the
+    login window. Reading the owner of /dev/console gives the same answer
+    as SCDynamicStoreCopyConsoleUser without loading SystemConfiguration.
+    '''
+    try:
+        username = pwd.getpwuid(os.stat("/dev/console").st_uid).pw_name
+    except (OSError, KeyError):
+        return ""
+    return [username, ""][username in ["root", "loginwindow"]]
+
+def securePreferences():
+    '''
+    Returns the dock preferences that keep the dock as is.
     '''
     preferences = {}
     preferences["contents-immutable"] = True
@@ -170,78 +1320,461 @@ def setPreferences():
     preferences["autohide"] = False
     preferences["autohide-immutable"] = True
     preferences["tilesize"] = int(60)
-    CFPreferencesSetMultiple(preferences, None,
-                             "com.apple.dock",
-                             kCFPreferencesCurrentUser,
-                             kCFPreferencesCurrentHost)
-    logging.info("dock-maintainer: Setting secure preferences")
+    return preferences
 
-def main():
+def managedUser(backend=None, session=False):
     '''
-    Main Stuff
+    Checks the console user is managed, exiting when not:
+    - Leaves early, before loading PyObjC, when the console user has no config
+    - Checks the console user is one of the managed users
+    With session, the user running this is checked instead, for sessions
+    in the background after fast user switching.
+    Returns (configFile, backend, keys). backend defaults to a
+    FoundationBackend for the current user.
+    '''
+    if backend:
+        username = backend.consoleUser()
+    elif session:
+        username = pwd.getpwuid(os.getuid()).pw_name
+    else:
+        username = consoleUser()
+    configFile = os.path.join(CONFIG_PATH, username)
+    if not username or not os.path.isfile(configFile):
+        logging.info("dock-maintainer: Exiting as user is not the right user")
+        exit(0)
+
+    with METRICS.span("backend_load"):
+        backend = backend or FoundationBackend()
+    keys = readKeys(backend)
+    if username not in managedUsers(keys):
+        logging.info("dock-maintainer: Exiting as user is not the right user")
+        exit(0)
+    return configFile, backend, keys
+
+def readKeys(backend):
+    '''
+    Returns the dock-maintainer preferences read through backend, and sets
+    the log level from them
     '''
     keys = {}
     keys["ManagedUser"] = \
-    CFPreferencesCopyAppValue("ManagedUser",
-                             "com.github.wardsparadox.dock-maintainer")
-    if keys["ManagedUser"] is None:
+    backend.copyAppValue("ManagedUser",
+                         "com.github.wardsparadox.dock-maintainer")
+    keys["Profiles"] = \
+    backend.copyAppValue("Profiles",
+                         "com.github.wardsparadox.dock-maintainer")
+    keys["LockDock"] = \
+    backend.copyAppValue("LockDock",
+                         "com.github.wardsparadox.dock-maintainer")
+    keys["ProfilePath"] = \
+    backend.copyAppValue("ProfilePath",
+                         "com.github.wardsparadox.dock-maintainer")
+    keys["LogLevel"] = \
+    backend.copyAppValue("LogLevel",
+                         "com.github.wardsparadox.dock-maintainer")
+    keys["MissingItemPolicy"] = \
+    backend.copyAppValue("MissingItemPolicy",
+                         "com.github.wardsparadox.dock-maintainer")
+    setLogLevel(keys["LogLevel"])
+    return keys
+
+def managedUsers(keys):
+    '''
+    Returns the users named by the ManagedUser and Profiles preferences,
+    exiting when there are none
+    '''
+    users = [profile.get("ManagedUser") for profile in keys["Profiles"] or []]
+    if keys["ManagedUser"] is not None:
+        users.append(keys["ManagedUser"])
+    if not users:
         logging.error("No ManagedUser Preference set!"
                       "Please set that via defaults write"
                       "com.github.wardsparadox.dock-maintainer ManagedUser nameofuser")
         exit(2)
-    configPath = os.path.realpath(
-        "/Library/Application Support/com.github.wardsparadox.dock-maintainer/")
+    return users
+
+def expandHome(thePath, home=None):
+    '''
+    Expands a leading ~ in thePath to home, the current user's by default
+    '''
+    if home and (thePath == "~" or thePath.startswith("~/")):
+        return home + thePath[1:]
+    return os.path.expanduser(thePath)
+
+def matchDock(config, dock, keys, home=None):
+    '''
+    Brings the sections of dock in line with config in memory only. home
+    is the folder ~ stands for in Others and the one whose fingerprint has
+    the folder listings to start from, the current user's by default.
+    Returns (apps_script, others_script, scan, missing), scan being None
+    when missing targets are added anyway.
+    '''
+    apps = config["Apps"]
+    app_paths = [entry["Path"] for entry in apps]
+    others = config["Others"]
+    other_paths = [expandHome(entry["Path"], home) for entry in others]
+    policy = str(keys["MissingItemPolicy"] or "defer").lower()
+    if policy not in MISSING_POLICIES:
+        logging.warning("dock-maintainer: Unknown MissingItemPolicy %s, using defer",
+                        keys["MissingItemPolicy"])
+        policy = "defer"
+    scan = None
+    missing = set()
+    if policy != "add":
+        scan = ExistenceScan(savedFolders(home))
+        with METRICS.span("existence_scan"):
+            missing = scan.missing(app_paths + other_paths)
+        METRICS.count("folders_listed", scan.listed)
+        METRICS.count("missing_items", len(missing))
+        if missing:
+            logging.warning("dock-maintainer: Not found on this Mac, applying the %s "
+                            "policy: %s", policy, ", ".join(sorted(missing)))
+        apps, app_paths = presentEntries(
+            apps, app_paths,
+            set(item.label for item in dock.items['persistent-apps']),
+            missing, policy)
+        others, other_paths = presentEntries(
+            others, other_paths,
+            set(item.label for item in dock.items['persistent-others']),
+            missing, policy)
+    templates = dict((entry["Path"], entry["Tile"])
+                     for entry in apps if "Tile" in entry)
+    if config.get("Merge"):
+        matchSection = dock.mergeSection
+    else:
+        matchSection = dock.reconcileSection
+    apps_script = matchSection(
+        'persistent-apps',
+        app_paths,
+        lambda app: (Tile.fromItem(templates[app]) if app in templates
+                     else dock.makeDockAppEntry(app)),
+        [entry["Label"] for entry in apps])
+    others_script = matchSection(
+        'persistent-others',
+        other_paths,
+        lambda item: dock.makeDockOtherEntry(item, 0, 1, 3),
+        [entry["Label"] for entry in others])
+    return apps_script, others_script, scan, missing
+
+def reconcile(configFile, backend, keys, tiles=None, started=None, user=None):
+    '''
+    Matches the Dock to configFile, writing and restarting it only when
+    something differs, and saves the fingerprint. user, a pwd entry, is
+    who the Dock belongs to when not the current user. tiles is the
+    TileFactory --watch keeps between runs, tiles are built directly
+    without one. Raises IOError when the config can not be read and
+    ExpatError when it is not a plist. Returns True if the Dock was
+    changed.
+    '''
+    started = started or time.time()
+    with METRICS.span("config_load"):
+        config = loadConfig(configFile)
+    logging.info("dock-maintainer: Input plist found. Matching docks.")
+    dock = Dock(backend, tiles)
+    apps_script, others_script, scan, missing = matchDock(config, dock, keys,
+                                                          user and user.pw_dir)
+    if apps_script:
+        logging.info("dock-maintainer: Dock Apps differ from config, applying %s",
+                     apps_script)
+    else:
+        logging.info("dock-maintainer: Dock Apps match Config Apps, nothing to change")
+    if others_script:
+        logging.info("dock-maintainer: Dock Other Items differ from config, applying %s",
+                     others_script)
+    else:
+        logging.info("dock-maintainer: Dock Other Items match Config Other Items, nothing to change")
+
+    preferences = None
+    if keys["LockDock"]:
+        logging.info("dock-maintainer: Setting secure preferences")
+        preferences = securePreferences()
+    changed = dock.save(preferences)
+    if changed:
+        logging.info("dock-maintainer: Killing Dock to finalize")
+    else:
+        print "dock does not need to be reloaded"
+    if dock.tiles is not None:
+        logging.info("dock-maintainer: Tile cache %d hits, %d misses",
+                     dock.tiles.hits, dock.tiles.misses)
+        METRICS.counters.update(tile_hits=dock.tiles.hits, tile_misses=dock.tiles.misses)
+    METRICS.set(Changed=changed, AppEdits=len(apps_script),
+                OtherEdits=len(others_script))
     try:
-        configPlist = plistlib.readPlist(os.path.join(configPath, keys["ManagedUser"]))
-        logging.info("dock-maintainer: Input plist found. Matching docks.")
+        with METRICS.span("fingerprint_save"):
+            saveFingerprint(time.time() - started, scan and scan.listings(),
+                            [os.path.normpath(thePath) for thePath in missing], user)
+    except (IOError, OSError) as err:
+        logging.warning("dock-maintainer: Could not save fingerprint: %s", err)
+    return changed
+
+def describeEdits(script):
+    '''
+    Returns an edit script from diffLabels as a list of dicts for JSON
+    '''
+    edits = []
+    for edit in script:
+        if edit[0] == 'move':
+            edits.append({"Action": "move", "Label": edit[1],
+                          "From": edit[2], "To": edit[3]})
+        elif edit[0] == 'insert':
+            edits.append({"Action": "insert", "Label": edit[1], "To": edit[2]})
+        else:
+            edits.append({"Action": "delete", "Label": edit[1], "From": edit[2]})
+    return edits
+
+def planUser(configFile, backend, keys, home=None):
+    '''
+    Works out what reconcile would do for configFile, reading the Dock
+    through backend but writing nothing and never restarting the Dock.
+    Returns a dict for JSON with the edit script of each section, the
+    Dock preferences that would change and the time each phase took.
+    '''
+    METRICS.reset()
+    result = {"User": backend.consoleUser(), "Config": configFile}
+    try:
+        with METRICS.span("config_load"):
+            config = loadConfig(configFile)
+        result["ConfigSHA256"] = hashFile(configFile)
+        dock = Dock(backend)
+    except (IOError, OSError, ExpatError, subprocess.CalledProcessError) as err:
+        result["Error"] = str(err)
+        return result
+    apps_script, others_script, _, missing = matchDock(config, dock, keys, home)
+    commit = DockCommit(dock)
+    if keys["LockDock"]:
+        commit.stagePreferences(securePreferences())
+    preferences = sorted(key for key in commit.changes() if key not in Dock._SECTIONS)
+    result.update({"Merge": bool(config.get("Merge")),
+                   "InSync": not (apps_script or others_script or preferences),
+                   "Sections": {"persistent-apps": describeEdits(apps_script),
+                                "persistent-others": describeEdits(others_script)},
+                   "Preferences": preferences,
+                   "Missing": sorted(missing),
+                   "Timings": METRICS.record()["Phases"]})
+    return result
+
+def plan(allUsers=False):
+    '''
+    Prints as JSON what reconcile would do for the console user or, with
+    allUsers, for every managed user with a config and a Dock plist in
+    their home, read from the plist files so it can run as root
+    '''
+    METRICS.set(Mode="plan")
+    if allUsers:
+        keys = readKeys(FoundationBackend())
+        plans = []
+        for username in sorted(set(managedUsers(keys))):
+            configFile = os.path.join(CONFIG_PATH, username)
+            try:
+                home = pwd.getpwnam(username).pw_dir
+            except KeyError:
+                continue
+            prefsdir = os.path.join(home, "Library", "Preferences")
+            if (not os.path.isfile(configFile) or
+                    not os.path.isfile(os.path.join(prefsdir, Dock._DOMAIN + ".plist"))):
+                continue
+            plans.append(planUser(configFile, PlistFileBackend(prefsdir, username),
+                                  keys, home))
+    else:
+        configFile, backend, keys = managedUser()
+        plans = [planUser(configFile, backend, keys)]
+    print json.dumps({"Version": 1, "Host": os.uname()[1], "Plans": plans},
+                     indent=2, sort_keys=True)
+
+def main(backend=None, session=False):
+    '''
+    Main Stuff
+    '''
+    configFile, backend, keys = managedUser(backend, session)
+    try:
+        if keys["ProfilePath"] and not os.environ.get(PROFILE_ENV):
+            runProfiled(os.path.expanduser(keys["ProfilePath"]), reconcile,
+                        configFile, backend, keys, None, _START)
+        else:
+            reconcile(configFile, backend, keys, started=_START)
     except IOError:
         logging.error("dock-maintainer: No input found! Make sure the updater is functioning!")
         exit(3)
-    username = (SCDynamicStoreCopyConsoleUser(None, None, None) or [None])[0]
-    username = [username, ""][username in [u"loginwindow", None, u""]]
-    if username != keys["ManagedUser"]:
-        logging.info("dock-maintainer: Exiting as user is not the right user")
-        exit(0)
+    except ExpatError as err:
+        logging.error("dock-maintainer: Config %s is not a valid plist: %s", configFile, err)
+        exit(3)
+
+def watch(backend=None, debounce=2.0):
+    '''
+    Keeps the Dock matched to the config: reconciles once, then again after
+    every burst of changes to the Dock plist or the config link has been quiet
+    for debounce seconds. Changes that leave the fingerprint as it was,
+    like our own writes, are skipped without loading the Dock.
+    '''
+    configFile, backend, keys = managedUser(backend)
+    tiles = TileFactory()
+    watcher = makeWatcher([Dock._DOCK_PLIST, configFile])
+    logging.info("dock-maintainer: Watching %s and %s", Dock._DOCK_PLIST, configFile)
+    while True:
+        METRICS.reset()
+        METRICS.set(Mode="watch")
+        with METRICS.span("fingerprint"):
+            matches = fingerprintMatches()
+        if not matches:
+            backend.refresh("com.github.wardsparadox.dock-maintainer")
+            keys = readKeys(backend)
+            try:
+                reconcile(configFile, backend, keys, tiles)
+            except IOError:
+                logging.error("dock-maintainer: No input found! "
+                              "Make sure the updater is functioning!")
+            except ExpatError as err:
+                logging.error("dock-maintainer: Config %s is not a valid plist: %s",
+                              configFile, err)
+            METRICS.write()
+        watcher.wait()
+        while watcher.wait(debounce):
+            pass
+
+def login(session=False):
+    '''
+    Runs once at login, skipping the reconcile when the fingerprint matches
+    '''
+    METRICS.set(Mode="login", ExitCode=0)
+    with METRICS.span("fingerprint"):
+        fingerprint = fingerprintMatches()
+    METRICS.set(FastPath=bool(fingerprint))
+    if fingerprint:
+        logging.info("dock-maintainer: Config and Dock unchanged since last run, "
+                     "skipping reconcile (%.3fs instead of %.3fs)",
+                     time.time() - _START, fingerprint["ReconcileSeconds"])
     else:
-        persistent_apps = dock.items['persistent-apps']
-        persistent_others = dock.items['persistent-others']
-        dock_apps = []
-        dock_others = []
-        config_apps = []
-        config_others = []
-        for dockapp in persistent_apps:
-            dock_apps.append(str(dockapp["tile-data"]["file-label"]))
-        for configapp in configPlist['Apps']:
-            config_apps.append(os.path.splitext(os.path.basename(configapp))[0])
-        for dockother in persistent_others:
-            dock_others.append(str(dockother["tile-data"]["file-label"]))
-        for configother in configPlist['Others']:
-            config_others.append(os.path.splitext(os.path.basename(configother))[0])
-
-        final_apps = []
-        final_others = []
-        if len(list(set(dock_apps) ^ set(config_apps))) > 0:
-            logging.info("dock-maintainer: App missing from dock, setting dock to config")
-            for app in configPlist['Apps']:
-                final_apps.append(dock.makeDockAppEntry(app))
-            dock.items['persistent-apps'] = final_apps
-        else:
-            logging.info("dock-maintainer: Dock Apps match Config Apps, nothing to change")
-        if len(list(set(dock_others) ^ set(config_others))) > 0:
-            logging.info("dock-maintainer: Other Item missing from dock, setting dock to config")
-            for item in configPlist['Others']:
-                final_others.append(dock.makeDockOtherEntry(os.path.expanduser(item), 0, 1, 3))
-                print item
-            dock.items['persistent-others'] = final_others
-        else:
-            logging.info("dock-maintainer: Dock Other Items match Config Other Items, nothing to change")
+        main(session=session)
+
+def guiSession(uid):
+    '''
+    Returns True if the user with uid has a GUI session, and so a live Dock
+    '''
+    with open(os.devnull, "w") as devnull:
+        return subprocess.call(["/bin/launchctl", "print", "gui/%d" % uid],
+                               stdout=devnull, stderr=devnull) == 0
 
-        if len(final_apps) or len(final_others) > 0:
-            dock.save()
+def _forwardLogs(logqueue):
+    '''sends the log records of a worker process to the parent'''
+    logging.getLogger().handlers = [QueueHandler(logqueue)]
+
+def _receiveLogs(logqueue):
+    '''hands the log records of the worker processes to the LogWriter'''
+    for record in iter(logqueue.get, None):
+        LOG_WRITER.put(record)
+
+def reconcileHome(args):
+    '''
+    Matches the Dock plist in the home of a user without a session to
+    their config, writing the file and the fingerprint as that user.
+    Runs in the worker processes of reconcileAllUsers. Returns
+    (username, result), result being "changed", "unchanged" or why it failed.
+    '''
+    username, keys = args
+    user = pwd.getpwnam(username)
+    backend = PlistFileBackend(os.path.join(user.pw_dir, "Library", "Preferences"),
+                               username, (user.pw_uid, user.pw_gid))
+    try:
+        changed = reconcile(os.path.join(CONFIG_PATH, username), backend, keys,
+                            user=user)
+    except (IOError, OSError, ExpatError, DockError,
+            subprocess.CalledProcessError) as err:
+        return username, "failed: %s" % err
+    return username, ["unchanged", "changed"][changed]
+
+def reconcileAllUsers():
+    '''
+    Matches the Dock of every managed user with a config and a Dock plist
+    in their home, run as root. Homes of users without a session are
+    handled offline, at most MaxWorkers processes at a time, so the Dock
+    is already right when they log in. Users with a session, behind fast
+    user switching or not, get the agent run in that session, which
+    restarts their Dock only if it changed.
+    '''
+    import multiprocessing
+    METRICS.set(Mode="all-users", ExitCode=0)
+    backend = FoundationBackend()
+    prefs = readKeys(backend)
+    maxworkers = backend.copyAppValue("MaxWorkers",
+                                      "com.github.wardsparadox.dock-maintainer")
+    # plain values, these are sent to the worker processes
+    keys = {"LockDock": bool(prefs["LockDock"]),
+            "MissingItemPolicy": prefs["MissingItemPolicy"] and
+                                 unicode(prefs["MissingItemPolicy"])}
+    offline = []
+    live = []
+    for username in sorted(set(managedUsers(prefs))):
+        try:
+            user = pwd.getpwnam(username)
+        except KeyError:
+            logging.info("dock-maintainer: %s has no account here, skipping", username)
+            continue
+        dockplist = os.path.join(user.pw_dir, "Library", "Preferences",
+                                 Dock._DOMAIN + ".plist")
+        if (not os.path.isfile(os.path.join(CONFIG_PATH, username)) or
+                not os.path.isfile(dockplist)):
+            logging.info("dock-maintainer: %s has no config or Dock yet, skipping",
+                         username)
+            continue
+        if guiSession(user.pw_uid):
+            live.append(user)
         else:
-            print "dock does not need to be reloaded"
-        logging.info("dock-maintainer: Killing Dock to finalize")
-        #setPreferences()
+            offline.append(username)
+    results = []
+    if offline:
+        logqueue = multiprocessing.Queue()
+        forwarder = threading.Thread(target=_receiveLogs, args=(logqueue,))
+        forwarder.start()
+        workers = multiprocessing.Pool(
+            max(1, min(int(maxworkers or multiprocessing.cpu_count()), len(offline))),
+            _forwardLogs, (logqueue,))
+        try:
+            results = workers.map(reconcileHome,
+                                  [(username, keys) for username in offline])
+        finally:
+            workers.close()
+            workers.join()
+            logqueue.put(None)
+            forwarder.join()
+    for user in live:
+        code = subprocess.call(["/bin/launchctl", "asuser", str(user.pw_uid),
+                                "/usr/bin/sudo", "-H", "-u", user.pw_name,
+                                sys.executable, os.path.abspath(__file__), "--session"])
+        results.append((user.pw_name, ["session", "failed: exit %d" % code][bool(code)]))
+    for username, result in results:
+        logging.info("dock-maintainer: %s: %s", username, result)
+        METRICS.count(result.split(":")[0])
+    if any(result.startswith("failed") for _, result in results):
+        exit(1)
 
 if __name__ == '__main__':
-    main()
+    PARSER = argparse.ArgumentParser(description="Keeps the Dock matched to its config.")
+    PARSER.add_argument("--watch", action="store_true",
+                        help="keep running and match the Dock again when it drifts")
+    PARSER.add_argument("--plan", action="store_true",
+                        help="print the changes as JSON without making them")
+    PARSER.add_argument("--all-users", action="store_true",
+                        help="as root, match the Dock of every managed user, "
+                             "or with --plan check them")
+    PARSER.add_argument("--session", action="store_true",
+                        help="act for the user running this rather than the console user")
+    ARGS = PARSER.parse_args()
+    if ARGS.plan:
+        ENTRY = lambda: plan(ARGS.all_users)
+    elif ARGS.all_users:
+        ENTRY = reconcileAllUsers
+    elif ARGS.watch:
+        ENTRY = watch
+    else:
+        ENTRY = lambda: login(ARGS.session)
+    try:
+        if os.environ.get(PROFILE_ENV):
+            runProfiled(os.environ[PROFILE_ENV], ENTRY)
+        else:
+            ENTRY()
+    except SystemExit as err:
+        METRICS.set(ExitCode=err.code)
+        raise
+    finally:
+        if METRICS.fields.get("Mode") in ("login", "all-users"):
+            METRICS.write()
@@ -0,0 +1,64 @@
+'''
+Stands in for the parts of PyObjC's Foundation the scripts use, so the tests
+run on any machine. Preferences are kept in
+$HOME/Library/Preferences/<domain>.plist and read and written with plistlib,
+the way cfprefsd keeps them for the current user.
+'''
+import os
+import plistlib
+import urllib
+
+kCFPreferencesCurrentUser = "kCFPreferencesCurrentUser"
+kCFPreferencesAnyHost = "kCFPreferencesAnyHost"
+
+_STAGED = {}
+
+def _path(domain):
+    return os.path.join(os.path.expanduser("~"), "Library", "Preferences",
+                        domain + ".plist")
+
+def _read(domain):
+    try:
+        return plistlib.readPlist(_path(domain))
+    except IOError:
+        return {}
+
+def CFPreferencesCopyAppValue(key, domain):
+    '''returns the staged or saved value of key in domain'''
+    if key in _STAGED.get(domain, {}):
+        return _STAGED[domain][key]
+    return _read(domain).get(key)
+
+def CFPreferencesSetAppValue(key, value, domain):
+    '''stages one value'''
+    _STAGED.setdefault(domain, {})[key] = value
+
+def CFPreferencesSetMultiple(values, remove, domain, user, host):
+    '''stages several values'''
+    _STAGED.setdefault(domain, {}).update(values)
+
+def CFPreferencesAppSynchronize(domain):
+    '''writes the staged values of domain to its plist'''
+    staged = _STAGED.pop(domain, {})
+    if staged:
+        prefs = _read(domain)
+        prefs.update(staged)
+        if not os.path.isdir(os.path.dirname(_path(domain))):
+            os.makedirs(os.path.dirname(_path(domain)))
+        plistlib.writePlist(prefs, _path(domain))
+    return True
+
+class NSURL(object):
+    '''just enough of NSURL to build file URL strings'''
+    def __init__(self, url):
+        self._url = url
+
+    @classmethod
+    def fileURLWithPath_(cls, thePath):
+        url = "file://" + urllib.pathname2url(os.path.abspath(thePath))
+        if os.path.isdir(thePath) and not url.endswith("/"):
+            url += "/"
+        return cls(url)
+
+    def absoluteString(self):
+        return self._url
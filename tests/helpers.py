@@ -0,0 +1,150 @@
+'''
+Shared bits of the tests: loading the two scripts as modules with the
+Foundation stand-in and a throwaway home, temp folders, and a local web
+server to stand in for the one serving the docksetup plists.
+'''
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import email.utils
+import gzip
+import hashlib
+import atexit
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TESTS)
+
+# set before the scripts are loaded, as they work out their paths from it
+HOME = tempfile.mkdtemp(prefix="dock-maintainer-home.")
+os.environ["HOME"] = HOME
+atexit.register(shutil.rmtree, HOME, True)
+sys.path.insert(0, TESTS)
+
+_SCRIPTS = {}
+
+def loadScript(name):
+    '''
+    Returns the script name, e.g. "dock-maintainer", loaded as a module.
+    Its log records are dropped rather than written.
+    '''
+    if name not in _SCRIPTS:
+        module = imp.load_source(name.replace("-", "_"), os.path.join(ROOT, name + ".py"))
+        module.LOG_WRITER.handlers = []
+        _SCRIPTS[name] = module
+    return _SCRIPTS[name]
+
+def tempDir(testcase):
+    '''returns a temp folder removed when testcase is done'''
+    folder = tempfile.mkdtemp(prefix="dock-maintainer-test.")
+    testcase.addCleanup(shutil.rmtree, folder, True)
+    return folder
+
+def docksetup(apps, others=(), merge=None):
+    '''returns a docksetup plist as a string'''
+    import plistlib
+    plist = {"Apps": list(apps), "Others": list(others)}
+    if merge is not None:
+        plist["Merge"] = merge
+    return plistlib.writePlistToString(plist)
+
+class _ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class StandInServer(object):
+    '''
+    A web server on localhost serving files, a dict of URL paths to bodies,
+    that can be changed while it runs. It sends an ETag and Last-Modified
+    with every file and answers matching conditional requests with 304.
+    Requests can be delayed by delay seconds or answered with status
+    instead, and bodies are gzipped when the client asks unless compress is
+    False. It counts requests, connections and the body bytes it sent.
+    '''
+    def __init__(self, files, delay=0, status=None, compress=True, etag=True):
+        self.files = dict(files)
+        self.delay = delay
+        self.status = status
+        self.compress = compress
+        self.etag = etag
+        self.requests = []
+        self.statuses = []
+        self.connections = 0
+        self.bytes = 0
+        self.modified = email.utils.formatdate(time.time() - 60, usegmt=True)
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                with server._lock:
+                    server.connections += 1
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+            def do_GET(self):
+                server._answer(self)
+
+            def do_HEAD(self):
+                self._send(200, {}, "")
+
+            def _send(self, status, headers, body):
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+                with server._lock:
+                    server.statuses.append(status)
+                    server.bytes += len(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = _ThreadingServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d" % self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _answer(self, handler):
+        with self._lock:
+            self.requests.append((handler.path, dict(handler.headers)))
+        if self.delay:
+            time.sleep(self.delay)
+        if self.status:
+            handler._send(self.status, {}, "")
+            return
+        body = self.files.get(handler.path)
+        if body is None:
+            handler._send(404, {}, "")
+            return
+        headers = {"Last-Modified": self.modified}
+        if self.etag:
+            headers["ETag"] = '"%s"' % hashlib.sha1(body).hexdigest()
+            if handler.headers.get("If-None-Match") == headers["ETag"]:
+                handler._send(304, headers, "")
+                return
+        elif handler.headers.get("If-Modified-Since") == self.modified:
+            handler._send(304, headers, "")
+            return
+        if self.compress and "gzip" in (handler.headers.get("Accept-Encoding") or ""):
+            buf = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb") as compressed:
+                compressed.write(body)
+            body = buf.getvalue()
+            headers["Content-Encoding"] = "gzip"
+        handler._send(200, headers, body)
+
+    def close(self):
+        '''stops the server'''
+        self._httpd.shutdown()
+        self._httpd.server_close()
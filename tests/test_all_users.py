@@ -0,0 +1,121 @@
+'''
+--all-users matches the Docks kept in many homes, a worker pool at a time
+'''
+import os
+import plistlib
+import pwd
+import unittest
+
+from helpers import HOME, loadScript, tempDir
+
+agent = loadScript("dock-maintainer")
+
+HOMES = 12
+
+class AllUsersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempDir(self)
+        self.configs = tempDir(self)
+        apps = tempDir(self)
+        self.apps = [os.path.join(apps, name) for name in ("Safari.app", "Mail.app")]
+        for thePath in self.apps:
+            os.mkdir(thePath)
+        self.users = {}
+        for index in range(HOMES):
+            username = "student%02d" % index
+            home = os.path.join(self.root, username)
+            os.makedirs(os.path.join(home, "Library", "Preferences"))
+            os.mkdir(os.path.join(home, "Documents"))
+            plistlib.writePlist({"persistent-apps": [], "persistent-others": []},
+                                self.dockPlist(home))
+            plistlib.writePlist({"Apps": self.apps[:1 + index % 2], "Others": ["~/Documents"]},
+                                os.path.join(self.configs, username))
+            self.users[username] = pwd.struct_passwd(
+                (username, "*", os.getuid(), os.getgid(), "", home, "/bin/bash"))
+        # one without a Dock yet, and one with no account here
+        self.users["newhire"] = pwd.struct_passwd(
+            ("newhire", "*", os.getuid(), os.getgid(), "", tempDir(self), "/bin/bash"))
+        plistlib.writePlist({"Apps": self.apps, "Others": []},
+                            os.path.join(self.configs, "newhire"))
+        self.prefs(Profiles=[{"ManagedUser": username}
+                             for username in sorted(self.users) + ["gone"]],
+                   MaxWorkers=3)
+
+        self.patch(agent.pwd, "getpwnam", self.getpwnam)
+        self.patch(agent, "guiSession", lambda uid: False)
+        self.patch(agent, "CONFIG_PATH", self.configs)
+        agent.METRICS.reset()
+
+    def patch(self, owner, name, value):
+        self.addCleanup(setattr, owner, name, getattr(owner, name))
+        setattr(owner, name, value)
+
+    def prefs(self, **values):
+        '''sets the dock-maintainer preferences the Foundation stub reads'''
+        path = os.path.join(HOME, "Library", "Preferences",
+                            "com.github.wardsparadox.dock-maintainer.plist")
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        plistlib.writePlist(values, path)
+        self.addCleanup(os.remove, path)
+
+    def getpwnam(self, username):
+        if username not in self.users:
+            raise KeyError(username)
+        return self.users[username]
+
+    @staticmethod
+    def dockPlist(home):
+        return os.path.join(home, "Library", "Preferences", "com.apple.dock.plist")
+
+    def test_every_home_is_matched_to_its_config(self):
+        agent.reconcileAllUsers()
+        self.assertEqual(agent.METRICS.counters["changed"], HOMES)
+        for index in range(HOMES):
+            home = self.users["student%02d" % index].pw_dir
+            dock = plistlib.readPlist(self.dockPlist(home))
+            self.assertEqual([item["tile-data"]["file-label"] for item in dock["persistent-apps"]],
+                             ["Safari", "Mail"][:1 + index % 2])
+            self.assertEqual([item["tile-data"]["file-data"]["_CFURLString"]
+                              for item in dock["persistent-others"]],
+                             [agent.fileURL(os.path.join(home, "Documents"))])
+            self.assertTrue(os.path.isfile(os.path.join(home, agent.FINGERPRINT_NAME)))
+        self.assertFalse(os.path.exists(self.dockPlist(self.users["newhire"].pw_dir)))
+
+    def test_second_run_changes_nothing(self):
+        agent.reconcileAllUsers()
+        stamps = [os.stat(self.dockPlist(user.pw_dir)).st_mtime
+                  for name, user in sorted(self.users.items()) if name != "newhire"]
+        agent.METRICS.reset()
+        agent.reconcileAllUsers()
+        self.assertEqual(agent.METRICS.counters["unchanged"], HOMES)
+        self.assertNotIn("changed", agent.METRICS.counters)
+        self.assertEqual([os.stat(self.dockPlist(user.pw_dir)).st_mtime
+                          for name, user in sorted(self.users.items()) if name != "newhire"],
+                         stamps)
+
+    def test_a_broken_home_fails_alone(self):
+        with open(self.dockPlist(self.users["student03"].pw_dir), "w") as broken:
+            broken.write("<plist>")
+        self.patch(agent.subprocess, "check_output", self.noPlutil)
+        with self.assertRaises(SystemExit) as exited:
+            agent.reconcileAllUsers()
+        self.assertEqual(exited.exception.code, 1)
+        self.assertEqual(agent.METRICS.counters["changed"], HOMES - 1)
+        self.assertEqual(agent.METRICS.counters["failed"], 1)
+
+    def test_folder_listings_come_from_the_users_fingerprint(self):
+        keys = {"LockDock": False, "MissingItemPolicy": None}
+        self.assertEqual(agent.reconcileHome(("student01", keys)), ("student01", "changed"))
+        self.assertGreater(agent.METRICS.counters["folders_listed"], 0)
+        agent.METRICS.reset()
+        self.assertEqual(agent.reconcileHome(("student01", keys)), ("student01", "unchanged"))
+        self.assertEqual(agent.METRICS.counters["folders_listed"], 0)
+
+    @staticmethod
+    def noPlutil(args, *rest, **options):
+        raise OSError(2, "No such file or directory", args[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+'''
+The Dock is only written and restarted when what is staged differs from
+what is stored
+'''
+import os
+import plistlib
+import unittest
+
+from helpers import loadScript, tempDir
+
+agent = loadScript("dock-maintainer")
+
+def dockItems(*names):
+    '''returns Dock items for apps called names'''
+    return [agent.Tile(name, "file:///Applications/%s.app/" % name, 'file-tile',
+                       (('file-type', 41),)).toItem() for name in names]
+
+class DockCommitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = agent.MemoryBackend({'com.apple.dock': {
+            'persistent-apps': dockItems("Safari", "Mail"), 'persistent-others': []}})
+        self.dock = agent.Dock(self.backend)
+
+    def test_edit_matching_nothing_is_not_committed(self):
+        self.dock.applyEdits([('remove', 'Gone'), ('replace', '/Applications/Gone.app', None)])
+        self.assertEqual(self.dock.changed, set())
+        self.assertFalse(self.dock.save())
+        self.assertEqual(self.backend.restarts, 0)
+
+    def test_section_set_to_what_is_stored_is_not_committed(self):
+        self.dock.setSection('persistent-apps', [agent.Tile.fromItem(item)
+                                                 for item in dockItems("Safari", "Mail")])
+        self.assertFalse(self.dock.save())
+        self.assertEqual(self.backend.restarts, 0)
+        self.assertEqual(self.backend.synchronized, 0)
+        self.assertEqual(self.dock.changed, set())
+
+    def test_only_changed_sections_are_written(self):
+        self.dock.setSection('persistent-others', [])
+        self.dock.applyEdits([('remove', 'Mail')])
+        self.assertTrue(self.dock.save())
+        self.assertEqual(self.backend.restarts, 1)
+        self.assertEqual([item["tile-data"]["file-label"] for item in
+                          self.backend.domains['com.apple.dock']['persistent-apps']],
+                         ["Safari"])
+
+    def test_preferences_already_set_are_not_committed(self):
+        self.backend.setAppValues(agent.securePreferences(), 'com.apple.dock')
+        self.assertFalse(self.dock.save(agent.securePreferences()))
+        self.assertEqual(self.backend.restarts, 0)
+
+    def test_plist_dock_read_back_is_not_rewritten(self):
+        prefs = tempDir(self)
+        safari = os.path.join(tempDir(self), "Safari.app")
+        os.mkdir(safari)
+        plist = os.path.join(prefs, "com.apple.dock.plist")
+        dock = agent.Dock(agent.MemoryBackend())
+        plistlib.writePlist({'persistent-apps': [dock.makeDockAppEntry(safari).toItem()],
+                             'persistent-others': []}, plist)
+        os.utime(plist, (0, 0))
+        backend = agent.PlistFileBackend(prefs)
+        dock = agent.Dock(backend)
+        dock.setSection('persistent-apps', [dock.makeDockAppEntry(safari)])
+        self.assertFalse(dock.save())
+        self.assertEqual(os.stat(plist).st_mtime, 0)
+        self.assertEqual(backend.restarts, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+'''
+Plists come over gzip on kept-alive connections and are stored decoded
+'''
+import os
+import unittest
+
+from helpers import loadScript, tempDir, docksetup, StandInServer
+
+updater = loadScript("dock-maintainer-updater")
+
+# a lab with many apps, about as repetitive as the real ones
+LAB = docksetup(["/Applications/App %03d.app" % index for index in range(300)],
+                ["/Applications", "~/Downloads"])
+OFFICE = docksetup(["/Applications/Safari.app", "/Applications/Mail.app"])
+
+class CompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempDir(self)
+        os.mkdir(os.path.join(self.path, updater.BLOBS))
+        updater.METRICS = updater.Metrics()
+        self.pool = updater.ConnectionPool()
+        self.addCleanup(self.pool.close)
+
+    def serve(self, **options):
+        server = StandInServer({"/lab.plist": LAB, "/office.plist": OFFICE}, **options)
+        self.addCleanup(server.close)
+        return server
+
+    def sync(self, server, username, filename):
+        profile = {"ManagedUser": username, "FileName": filename,
+                   "ServerURL": server.url, "Sources": [server.url]}
+        result, _ = updater.syncProfile(profile, self.path, {}, self.pool, False)
+        self.assertEqual(result, "updated")
+        with open(os.path.join(self.path, username)) as stored:
+            return stored.read()
+
+    def test_gzip_sends_less_and_stores_the_same(self):
+        server = self.serve()
+        self.assertEqual(self.sync(server, "student", "lab.plist"), LAB)
+        self.assertEqual(self.sync(server, "staff", "office.plist"), OFFICE)
+        counters = updater.METRICS.counters
+        self.assertEqual(counters["bytes_read"], len(LAB) + len(OFFICE))
+        self.assertEqual(counters["bytes_wire"], server.bytes)
+        self.assertLess(counters["bytes_wire"] * 5, counters["bytes_read"])
+        self.assertTrue(all(headers["accept-encoding"] == "gzip"
+                            for _, headers in server.requests))
+        self.assertEqual(server.connections, 1)
+
+    def test_plain_server_is_read_as_is(self):
+        server = self.serve(compress=False)
+        self.assertEqual(self.sync(server, "student", "lab.plist"), LAB)
+        self.assertEqual(self.sync(server, "staff", "office.plist"), OFFICE)
+        counters = updater.METRICS.counters
+        self.assertEqual(counters["bytes_wire"], counters["bytes_read"])
+        self.assertEqual(counters["bytes_wire"], server.bytes)
+        self.assertEqual(server.connections, 1)
+
+    def test_gzip_body_decodes_in_small_reads(self):
+        server = self.serve()
+        response = self.pool.request(server.url + "/lab.plist")
+        pieces = list(iter(lambda: response.read(64), ""))
+        self.assertEqual("".join(pieces), LAB)
+        self.assertTrue(all(pieces))
+        # the connection went back to the pool once the body was read
+        self.pool.request(server.url + "/office.plist").read()
+        self.assertEqual(server.connections, 1)
+
+if __name__ == '__main__':
+    unittest.main()
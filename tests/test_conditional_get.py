@@ -0,0 +1,85 @@
+'''
+The updater only downloads a plist again when the server says it changed
+'''
+import os
+import unittest
+
+from helpers import loadScript, tempDir, docksetup, StandInServer
+
+updater = loadScript("dock-maintainer-updater")
+
+LAB = docksetup(["/Applications/Safari.app", "/Applications/Mail.app"])
+
+class ConditionalGetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempDir(self)
+        os.mkdir(os.path.join(self.path, updater.BLOBS))
+        updater.METRICS = updater.Metrics()
+        self.pool = updater.ConnectionPool()
+        self.addCleanup(self.pool.close)
+
+    def serve(self, **options):
+        server = StandInServer({"/lab.plist": LAB}, **options)
+        self.addCleanup(server.close)
+        return server
+
+    def sync(self, server, userstate):
+        profile = {"ManagedUser": "student", "FileName": "lab.plist",
+                   "ServerURL": server.url, "Sources": [server.url]}
+        return updater.syncProfile(profile, self.path, userstate, self.pool, False)
+
+    def test_unchanged_plist_costs_one_304(self):
+        server = self.serve()
+        result, userstate = self.sync(server, {})
+        self.assertEqual(result, "updated")
+        self.assertEqual(userstate["URL"], server.url + "/lab.plist")
+        self.assertIn("ETag", userstate)
+        sent = server.bytes
+
+        result, userstate = self.sync(server, userstate)
+        self.assertEqual(result, "synced")
+        self.assertEqual(server.statuses, [200, 304])
+        self.assertEqual(server.bytes, sent)
+        self.assertEqual(server.requests[1][1]["if-none-match"], userstate["ETag"])
+        self.assertEqual(updater.METRICS.counters["requests"], 2)
+
+    def test_last_modified_alone_is_enough(self):
+        server = self.serve(etag=False)
+        result, userstate = self.sync(server, {})
+        self.assertNotIn("ETag", userstate)
+        result, userstate = self.sync(server, userstate)
+        self.assertEqual(result, "synced")
+        self.assertEqual(server.statuses, [200, 304])
+
+    def test_changed_plist_is_downloaded_and_kept_in_history(self):
+        server = self.serve()
+        _, userstate = self.sync(server, {})
+        first = updater.currentDigest(self.path, "student")
+        server.files["/lab.plist"] = docksetup(["/Applications/Safari.app"])
+
+        result, userstate = self.sync(server, userstate)
+        self.assertEqual(result, "updated")
+        self.assertEqual(server.statuses, [200, 200])
+        self.assertEqual(userstate["History"], [first])
+        self.assertNotEqual(updater.currentDigest(self.path, "student"), first)
+
+    def test_lost_plist_is_downloaded_unconditionally(self):
+        server = self.serve()
+        _, userstate = self.sync(server, {})
+        os.remove(os.path.join(self.path, "student"))
+
+        result, _ = self.sync(server, userstate)
+        self.assertEqual(result, "updated")
+        self.assertNotIn("if-none-match", server.requests[1][1])
+
+    def test_validators_of_another_url_are_not_sent(self):
+        validators = {"URL": "http://old.example.com/lab.plist", "ETag": '"1"',
+                      "Last-Modified": "Mon, 01 Jan 2018 00:00:00 GMT"}
+        self.assertEqual(updater.makeHeaders("http://example.com/lab.plist", validators), {})
+        self.assertEqual(updater.makeHeaders(validators["URL"], validators),
+                         {"If-None-Match": '"1"',
+                          "If-Modified-Since": "Mon, 01 Jan 2018 00:00:00 GMT"})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+'''
+Dock lookups go through a label and URL index that stays right across edits
+'''
+import random
+import time
+import unittest
+
+from helpers import loadScript
+
+agent = loadScript("dock-maintainer")
+
+def makeDock(tiles, section='persistent-apps'):
+    '''returns a Dock over a MemoryBackend holding tiles in section'''
+    dock = agent.Dock(agent.MemoryBackend({'com.apple.dock': {}}))
+    dock.items[section] = list(tiles)
+    return dock
+
+def firstIndex(items, attribute, value):
+    '''the linear scan the index stands in for'''
+    for index, item in enumerate(items):
+        if getattr(item, attribute) == value:
+            return index
+    return -1
+
+class SectionIndexTest(unittest.TestCase):
+
+    def test_duplicates_resolve_to_the_first_left(self):
+        dock = makeDock([agent.Tile("Mail", "file:///a/"), agent.Tile("Mail", "file:///b/"),
+                         agent.Tile("Safari", "file:///c/")])
+        self.assertEqual(dock.findExistingLabel("Mail"), 0)
+        dock.removeDockEntry("Mail", 'persistent-apps')
+        self.assertEqual(dock.findExistingLabel("Mail"), 0)
+        self.assertEqual(dock.findExistingURL("file:///b/"), 0)
+        self.assertEqual(dock.findExistingURL("file:///a/"), -1)
+        self.assertEqual(dock.findExistingLabel("Safari"), 1)
+        dock.removeDockEntry("Mail", 'persistent-apps')
+        self.assertEqual(dock.findExistingLabel("Mail"), -1)
+        self.assertEqual(dock.findExistingLabel("Safari"), 0)
+
+    def test_matches_a_linear_scan_through_random_edits(self):
+        rand = random.Random(5)
+        for _ in range(300):
+            dock = makeDock([agent.Tile("L%d" % rand.randint(0, 8), "U%d" % rand.randint(0, 8))
+                             for _ in range(rand.randint(0, 25))])
+            for _ in range(15):
+                items = dock.items['persistent-apps']
+                if rand.random() < 0.6 or not items:
+                    dock.removeDockEntry("L%d" % rand.randint(0, 8), 'persistent-apps')
+                else:
+                    index = dock._sectionIndex('persistent-apps')
+                    position = rand.randrange(len(items))
+                    old_item = items[position]
+                    items[position] = agent.Tile("L%d" % rand.randint(0, 8),
+                                                 "U%d" % rand.randint(0, 8))
+                    index.replace(position, old_item, items[position])
+                for key in range(9):
+                    self.assertEqual(dock.findExistingLabel("L%d" % key),
+                                     firstIndex(items, "label", "L%d" % key))
+                    self.assertEqual(dock.findExistingURL("U%d" % key),
+                                     firstIndex(items, "url", "U%d" % key))
+
+    def test_batch_edits(self):
+        dock = makeDock([agent.Tile("A", "file:///A/"), agent.Tile("B", "file:///B/"),
+                         agent.Tile("C", "file:///C/")])
+        dock.removeDockEntry("A", 'persistent-apps')
+        dock.applyEdits([('remove', 'C'), ('replace', '/Applications/B.app', None),
+                         ('add', '/Applications/D.app'), ('remove', 'Gone')])
+        self.assertEqual([tile.label for tile in dock.items['persistent-apps']], ["B", "D"])
+        self.assertEqual(dock.items['persistent-apps'][0].url,
+                         agent.fileURL('/Applications/B.app'))
+        self.assertEqual(dock.findExistingLabel("D"), 1)
+        self.assertIn('persistent-apps', dock.changed)
+
+class ScalingTest(unittest.TestCase):
+
+    @staticmethod
+    def removeHalf(size):
+        '''returns the seconds it takes to look up and remove every other
+            tile of a section of size tiles'''
+        dock = makeDock([agent.Tile("App%d" % index, "file:///App%d/" % index)
+                         for index in range(size)])
+        start = time.time()
+        for index in range(0, size, 2):
+            dock.removeDockEntry("App%d" % index, 'persistent-apps')
+            dock.findExistingLabel("App%d" % (index + 1))
+        seconds = time.time() - start
+        assert len(dock.items['persistent-apps']) == size // 2
+        return seconds
+
+    def test_edits_scale_linearly_from_10_to_10000_tiles(self):
+        timings = dict((size, min(self.removeHalf(size) for _ in range(3)))
+                       for size in (10, 100, 1000, 10000))
+        # a rescan or rebuild per edit would make 10x the tiles cost 100x
+        self.assertLess(timings[10000], 40 * max(timings[1000], 0.001))
+        self.assertLess(timings[10000], 2.0)
+
+if __name__ == '__main__':
+    unittest.main()
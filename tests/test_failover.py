@@ -0,0 +1,170 @@
+'''
+A profile's plist comes from the first of its sources that answers well,
+with slow sources hedged and hung ones given up on
+'''
+import os
+import threading
+import time
+import unittest
+
+from helpers import loadScript, tempDir, docksetup, StandInServer
+
+updater = loadScript("dock-maintainer-updater")
+
+LAB = docksetup(["/Applications/Safari.app", "/Applications/Mail.app"])
+
+class Attempts(object):
+    '''
+    An attempt function whose answer per source is a value, an exception
+    to raise or a threading.Event to wait on first, and that records the
+    order sources were tried in
+    '''
+    def __init__(self, answers):
+        self.answers = answers
+        self.tried = []
+        self.hold = threading.Event()
+
+    def __call__(self, source):
+        self.tried.append(source)
+        answer = self.answers[source]
+        if answer is self.hold:
+            answer.wait(5)
+            return source + " late"
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+class FirstSuccessTest(unittest.TestCase):
+
+    def setUp(self):
+        updater.METRICS = updater.Metrics()
+
+    def attempts(self, **answers):
+        attempts = Attempts(answers)
+        self.addCleanup(attempts.hold.set)
+        return attempts
+
+    def test_sources_are_tried_in_order_until_one_answers(self):
+        attempts = self.attempts(a=None, b=IOError("down"), c="plist", d="other")
+        self.assertEqual(updater.firstSuccess("abcd", attempts), ("c", "plist"))
+        self.assertEqual(attempts.tried, ["a", "b", "c"])
+        self.assertEqual(updater.METRICS.counters["failovers"], 2)
+        self.assertNotIn("hedges", updater.METRICS.counters)
+
+    def test_nothing_answers(self):
+        attempts = self.attempts(a=None, b=ValueError("bad"))
+        self.assertEqual(updater.firstSuccess("ab", attempts), (None, None))
+        self.assertEqual(attempts.tried, ["a", "b"])
+
+    def test_slow_source_is_hedged(self):
+        attempts = self.attempts(b="plist", c="other")
+        attempts.answers["a"] = attempts.hold
+        start = time.time()
+        self.assertEqual(updater.firstSuccess("abc", attempts, hedge=0.05), ("b", "plist"))
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual(attempts.tried, ["a", "b"])
+        self.assertEqual(updater.METRICS.counters["hedges"], 1)
+
+    def test_hedged_source_can_still_win(self):
+        attempts = self.attempts(a="plist")
+        attempts.answers["a"] = attempts.hold
+        attempts.answers["b"] = attempts.hold
+        threading.Timer(0.2, attempts.hold.set).start()
+        source, result = updater.firstSuccess("ab", attempts, hedge=0.05)
+        self.assertIn(source, ("a", "b"))
+        self.assertEqual(result, source + " late")
+        self.assertEqual(attempts.tried, ["a", "b"])
+
+    def test_hung_source_is_given_up_on_at_the_timeout(self):
+        attempts = self.attempts(b="plist")
+        attempts.answers["a"] = attempts.hold
+        start = time.time()
+        self.assertEqual(updater.firstSuccess("ab", attempts, timeout=0.1), ("b", "plist"))
+        seconds = time.time() - start
+        self.assertGreaterEqual(seconds, 0.1)
+        self.assertLess(seconds, 1.0)
+        self.assertNotIn("hedges", updater.METRICS.counters)
+
+    def test_timeout_on_the_last_source_gives_up(self):
+        attempts = self.attempts()
+        attempts.answers["a"] = attempts.hold
+        start = time.time()
+        self.assertEqual(updater.firstSuccess("a", attempts, timeout=0.1), (None, None))
+        self.assertLess(time.time() - start, 1.0)
+
+class MirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempDir(self)
+        os.mkdir(os.path.join(self.path, updater.BLOBS))
+        updater.METRICS = updater.Metrics()
+        self.sleeps = []
+        self.pool = updater.ConnectionPool(sleep=self.sleeps.append, jitter=lambda: 1.0)
+        self.addCleanup(self.pool.close)
+
+    def serve(self, body=LAB, **options):
+        server = StandInServer({"/lab.plist": body}, **options)
+        self.addCleanup(server.close)
+        return server
+
+    def sync(self, servers, **options):
+        profile = {"ManagedUser": "student", "FileName": "lab.plist",
+                   "ServerURL": servers[0].url,
+                   "Sources": [server.url for server in servers]}
+        result, userstate = updater.syncProfile(profile, self.path, {}, self.pool, False,
+                                                **options)
+        return result, userstate.get("URL")
+
+    def stored(self):
+        with open(os.path.join(self.path, "student")) as stored:
+            return stored.read()
+
+    def test_failed_primary_moves_to_the_mirror(self):
+        primary, mirror = self.serve(status=500), self.serve()
+        self.assertEqual(self.sync([primary, mirror]), ("updated", mirror.url + "/lab.plist"))
+        self.assertEqual(self.stored(), LAB)
+        self.assertEqual(primary.statuses, [500])
+        self.assertEqual(updater.METRICS.counters["failovers"], 1)
+
+    def test_busy_primary_is_retried_before_moving_on(self):
+        primary, mirror = self.serve(status=503), self.serve()
+        self.assertEqual(self.sync([primary, mirror])[0], "updated")
+        self.assertEqual(len(primary.statuses), self.pool.retries + 1)
+        self.assertEqual(len(self.sleeps), self.pool.retries)
+        self.assertEqual(mirror.statuses, [200])
+
+    def test_mirror_that_is_not_a_docksetup_is_skipped(self):
+        captive = self.serve("<html><body>Sign in to the wifi</body></html>")
+        truncated = self.serve(LAB[:len(LAB) // 2])
+        good = self.serve()
+        self.assertEqual(self.sync([captive, truncated, good]),
+                         ("updated", good.url + "/lab.plist"))
+        self.assertEqual(self.stored(), LAB)
+        self.assertEqual(os.listdir(os.path.join(self.path, updater.BLOBS)).count(
+            updater.currentDigest(self.path, "student")), 1)
+
+    def test_no_good_source_keeps_the_cached_plist(self):
+        good = self.serve()
+        self.sync([good])
+        result, _ = self.sync([self.serve(status=500), self.serve("<html></html>")])
+        self.assertEqual(result, "failed")
+        self.assertEqual(self.stored(), LAB)
+
+    def test_slow_primary_is_hedged_with_the_mirror(self):
+        primary, mirror = self.serve(delay=2), self.serve()
+        start = time.time()
+        self.assertEqual(self.sync([primary, mirror], hedge=0.1),
+                         ("updated", mirror.url + "/lab.plist"))
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(updater.METRICS.counters["hedges"], 1)
+
+    def test_hung_primary_is_timed_out(self):
+        primary, mirror = self.serve(delay=2), self.serve()
+        start = time.time()
+        self.assertEqual(self.sync([primary, mirror], timeout=0.2)[0], "updated")
+        seconds = time.time() - start
+        self.assertGreaterEqual(seconds, 0.2)
+        self.assertLess(seconds, 1.5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+'''
+Logging never holds up the maintainer and its files stay bounded
+'''
+import gzip
+import logging
+import os
+import threading
+import time
+import unittest
+
+from helpers import loadScript, tempDir
+
+agent = loadScript("dock-maintainer")
+
+class SlowHandler(logging.Handler):
+    '''a handler that holds every record until released'''
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.released = threading.Event()
+        self.messages = []
+
+    def emit(self, record):
+        self.released.wait()
+        self.messages.append(record.getMessage())
+
+def makeLogger(writer):
+    '''returns a logger of its own sending records to writer'''
+    logger = logging.getLogger("test_logging.%d" % id(writer))
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(agent.QueueHandler(writer))
+    return logger
+
+class LogWriterTest(unittest.TestCase):
+
+    def test_slow_handler_does_not_block_and_the_queue_is_bounded(self):
+        handler = SlowHandler()
+        writer = agent.LogWriter([handler], maxsize=10)
+        writer.start()
+        logger = makeLogger(writer)
+
+        start = time.time()
+        for index in range(1000):
+            logger.info("record %d", index)
+        seconds = time.time() - start
+        self.assertLess(seconds, 1.0)
+        self.assertLessEqual(writer.queue.qsize(), 10)
+        # the writer may have taken one record off before it got stuck
+        self.assertIn(writer.dropped, (989, 990))
+
+        handler.released.set()
+        writer.stop()
+        self.assertEqual(handler.messages[0], "record 0")
+        self.assertEqual(handler.messages[-1],
+                         "Dropped %d log records, the log queue was full" % writer.dropped)
+        self.assertEqual(len(handler.messages), 1000 - writer.dropped + 1)
+
+    def test_arguments_are_merged_before_queueing(self):
+        handler = SlowHandler()
+        handler.released.set()
+        writer = agent.LogWriter([handler])
+        logger = makeLogger(writer)
+        items = ["Safari"]
+        logger.info("apps %s", items)
+        items.append("Mail")
+        writer.start()
+        writer.stop()
+        self.assertEqual(handler.messages, ["apps ['Safari']"])
+
+class GzipRotatingFileHandlerTest(unittest.TestCase):
+
+    def test_rotated_logs_are_gzipped_and_bounded(self):
+        filename = os.path.join(tempDir(self), "dock-maintainer.log")
+        handler = agent.GzipRotatingFileHandler(filename, maxBytes=500, backupCount=3,
+                                                delay=True)
+        self.assertFalse(os.path.exists(filename))
+        logger = logging.getLogger("test_logging.rotate")
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        for index in range(200):
+            logger.warning("record %03d of a log that keeps growing", index)
+        handler.close()
+
+        names = sorted(os.listdir(os.path.dirname(filename)))
+        self.assertEqual(names, ["dock-maintainer.log", "dock-maintainer.log.1.gz",
+                                 "dock-maintainer.log.2.gz", "dock-maintainer.log.3.gz"])
+        self.assertLessEqual(os.path.getsize(filename), 500)
+        newest = gzip.open(filename + ".1.gz").read()
+        older = gzip.open(filename + ".2.gz").read()
+        self.assertLessEqual(len(newest), 500)
+        self.assertLess(older.splitlines()[-1], newest.splitlines()[0])
+        self.assertIn("record 199", open(filename).read())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+'''
+A login with nothing to do is over before PyObjC is loaded
+'''
+import json
+import os
+import plistlib
+import pwd
+import subprocess
+import sys
+import unittest
+
+from helpers import ROOT, TESTS, tempDir
+
+# runs one login in a fresh interpreter, as the LaunchAgent would, and
+# reports whether Foundation got imported
+LOGIN = '''
+import imp, json, sys
+sys.path.insert(0, %(tests)r)
+agent = imp.load_source("dock_maintainer", %(script)r)
+agent.LOG_WRITER.handlers = []
+agent.CONFIG_PATH = %(configs)r
+agent.FoundationBackend.restartDock = lambda self: None
+code = 0
+try:
+    agent.login(session=True)
+except SystemExit as err:
+    code = err.code or 0
+print json.dumps({"Code": code,
+                  "Foundation": "Foundation" in sys.modules,
+                  "FastPath": agent.METRICS.fields.get("FastPath")})
+'''
+
+class StartupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.home = tempDir(self)
+        self.configs = tempDir(self)
+        self.prefs = os.path.join(self.home, "Library", "Preferences")
+        os.makedirs(self.prefs)
+        self.username = pwd.getpwuid(os.getuid()).pw_name
+
+    def login(self):
+        env = dict(os.environ, HOME=self.home)
+        output = subprocess.check_output(
+            [sys.executable, "-c", LOGIN % {"tests": TESTS, "configs": self.configs,
+                                            "script": os.path.join(ROOT, "dock-maintainer.py")}],
+            env=env)
+        return json.loads(output.strip().splitlines()[-1])
+
+    def manage(self):
+        '''makes the current user managed, with a config of two apps'''
+        apps = tempDir(self)
+        paths = [os.path.join(apps, name) for name in ("Safari.app", "Mail.app")]
+        for thePath in paths:
+            os.mkdir(thePath)
+        plistlib.writePlist({"Apps": paths, "Others": []},
+                            os.path.join(self.configs, self.username))
+        plistlib.writePlist({"ManagedUser": self.username},
+                            os.path.join(self.prefs, "com.github.wardsparadox.dock-maintainer.plist"))
+        plistlib.writePlist({"persistent-apps": [], "persistent-others": []},
+                            os.path.join(self.prefs, "com.apple.dock.plist"))
+
+    def test_unmanaged_user_exits_without_foundation(self):
+        result = self.login()
+        self.assertEqual(result["Code"], 0)
+        self.assertFalse(result["Foundation"])
+
+    def test_cold_then_warm_login(self):
+        self.manage()
+        cold = self.login()
+        self.assertEqual(cold["Code"], 0)
+        self.assertFalse(cold["FastPath"])
+        self.assertTrue(cold["Foundation"])
+        dock = plistlib.readPlist(os.path.join(self.prefs, "com.apple.dock.plist"))
+        self.assertEqual([item["tile-data"]["file-label"] for item in dock["persistent-apps"]],
+                         ["Safari", "Mail"])
+
+        warm = self.login()
+        self.assertTrue(warm["FastPath"])
+        self.assertFalse(warm["Foundation"])
+
+    def test_preference_change_ends_the_fast_path(self):
+        self.manage()
+        self.login()
+        prefs = os.path.join(self.prefs, "com.github.wardsparadox.dock-maintainer.plist")
+        plistlib.writePlist({"ManagedUser": self.username, "LockDock": True}, prefs)
+        os.utime(prefs, (0, 0))
+        result = self.login()
+        self.assertFalse(result["FastPath"])
+        dock = plistlib.readPlist(os.path.join(self.prefs, "com.apple.dock.plist"))
+        self.assertTrue(dock["contents-immutable"])
+        self.assertTrue(self.login()["FastPath"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+'''
+--watch keeps built tiles between reconciles and drops them when their
+target changes
+'''
+import os
+import plistlib
+import unittest
+
+from helpers import loadScript, tempDir
+
+agent = loadScript("dock-maintainer")
+
+KEYS = {"LockDock": False, "MissingItemPolicy": None}
+
+class Builds(object):
+    '''a build function that counts its calls'''
+    def __init__(self):
+        self.paths = []
+
+    def __call__(self, thePath):
+        self.paths.append(thePath)
+        return agent.Tile(os.path.basename(thePath), agent.fileURL(thePath))
+
+class TileFactoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempDir(self)
+        self.build = Builds()
+
+    def app(self, name):
+        thePath = os.path.join(self.folder, name)
+        if not os.path.exists(thePath):
+            os.mkdir(thePath)
+        return thePath
+
+    def test_repeat_get_hits(self):
+        tiles = agent.TileFactory()
+        safari = self.app("Safari.app")
+        first = tiles.get(safari, ('persistent-apps',), self.build)
+        self.assertIs(tiles.get(safari, ('persistent-apps',), self.build), first)
+        self.assertEqual((tiles.hits, tiles.misses), (1, 1))
+        self.assertEqual(self.build.paths, [safari])
+
+    def test_options_are_part_of_the_key(self):
+        tiles = agent.TileFactory()
+        safari = self.app("Safari.app")
+        tiles.get(safari, ('persistent-apps',), self.build)
+        tiles.get(safari, ('persistent-others', 0, 1, 0), self.build)
+        self.assertEqual((tiles.hits, tiles.misses), (0, 2))
+
+    def test_changed_mtime_misses_and_drops_the_old_tile(self):
+        tiles = agent.TileFactory()
+        safari = self.app("Safari.app")
+        tiles.get(safari, ('persistent-apps',), self.build)
+        os.utime(safari, (0, 0))
+        tiles.get(safari, ('persistent-apps',), self.build)
+        self.assertEqual((tiles.hits, tiles.misses), (0, 2))
+        self.assertEqual(len(tiles._templates), 1)
+
+    def test_missing_target_is_rebuilt_once_it_appears(self):
+        tiles = agent.TileFactory()
+        mail = os.path.join(self.folder, "Mail.app")
+        tiles.get(mail, ('persistent-apps',), self.build)
+        tiles.get(mail, ('persistent-apps',), self.build)
+        self.app("Mail.app")
+        tiles.get(mail, ('persistent-apps',), self.build)
+        self.assertEqual((tiles.hits, tiles.misses), (1, 2))
+
+    def test_least_recently_used_is_evicted(self):
+        tiles = agent.TileFactory(maxsize=2)
+        first, second, third = [self.app("App%d.app" % index) for index in range(3)]
+        tiles.get(first, ('persistent-apps',), self.build)
+        tiles.get(second, ('persistent-apps',), self.build)
+        tiles.get(first, ('persistent-apps',), self.build)
+        tiles.get(third, ('persistent-apps',), self.build)
+        self.assertEqual(len(tiles._templates), 2)
+        self.assertEqual(len(tiles._keys), 2)
+        tiles.get(first, ('persistent-apps',), self.build)
+        tiles.get(second, ('persistent-apps',), self.build)
+        self.assertEqual(self.build.paths, [first, second, third, second])
+
+class DockTilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempDir(self)
+        self.paths = []
+        for name in ("Safari.app", "Mail.app", "Notes.app"):
+            self.paths.append(os.path.join(self.folder, name))
+            os.mkdir(self.paths[-1])
+        self.config = os.path.join(self.folder, "config.plist")
+        plistlib.writePlist({"Apps": self.paths, "Others": []}, self.config)
+        agent.METRICS.reset()
+
+    def reconcile(self, tiles):
+        '''reconciles an empty Dock with the config, returning the backend'''
+        backend = agent.MemoryBackend({'com.apple.dock': {'persistent-apps': [],
+                                                          'persistent-others': []}})
+        self.assertTrue(agent.reconcile(self.config, backend, KEYS, tiles))
+        labels = [item["tile-data"]["file-label"]
+                  for item in backend.domains['com.apple.dock']['persistent-apps']]
+        self.assertEqual(labels, ["Safari", "Mail", "Notes"])
+        return backend
+
+    def test_without_a_factory_tiles_are_built_directly(self):
+        dock = agent.Dock(agent.MemoryBackend())
+        tile = dock.makeDockAppEntry(self.paths[0])
+        self.assertIsNot(dock.makeDockAppEntry(self.paths[0]), tile)
+        self.reconcile(None)
+        self.assertNotIn("tile_hits", agent.METRICS.counters)
+
+    def test_watch_reconciles_share_the_factory(self):
+        tiles = agent.TileFactory()
+        self.reconcile(tiles)
+        self.assertEqual((tiles.hits, tiles.misses), (0, 3))
+        self.reconcile(tiles)
+        self.assertEqual((tiles.hits, tiles.misses), (3, 3))
+        self.assertEqual(agent.METRICS.counters["tile_hits"], 3)
+
+if __name__ == '__main__':
+    unittest.main()
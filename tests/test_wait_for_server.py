@@ -0,0 +1,89 @@
+'''
+The updater waits for the network with a bounded, jittered backoff
+'''
+import socket
+import unittest
+
+from helpers import loadScript, tempDir, StandInServer
+
+updater = loadScript("dock-maintainer-updater")
+
+class FakeNetwork(object):
+    '''
+    A clock that only moves when slept on, and a probe that comes up once
+    the clock reaches up_at
+    '''
+    def __init__(self, up_at=None):
+        self.now = 1000.0
+        self.up_at = up_at
+        self.sleeps = []
+        self.probes = 0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def probe(self):
+        self.probes += 1
+        return self.up_at is not None and self.now - 1000.0 >= self.up_at
+
+class WaitForServerTest(unittest.TestCase):
+
+    def wait(self, network, deadline, jitter=lambda: 1.0, **options):
+        return updater.wait_for_server(network.probe, deadline, network.clock,
+                                       network.sleep, jitter, **options)
+
+    def test_up_at_once_does_not_sleep(self):
+        network = FakeNetwork(up_at=0)
+        self.assertTrue(self.wait(network, 300))
+        self.assertEqual(network.sleeps, [])
+        self.assertEqual(network.probes, 1)
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        network = FakeNetwork(up_at=100)
+        self.assertTrue(self.wait(network, 300))
+        self.assertEqual(network.sleeps[:8], [0.5, 1, 2, 4, 8, 16, 30, 30])
+
+    def test_jitter_sleeps_between_half_and_all_of_the_backoff(self):
+        network = FakeNetwork(up_at=20)
+        self.wait(network, 300, jitter=lambda: 0.0)
+        self.assertEqual(network.sleeps[:4], [0.25, 0.5, 1, 2])
+
+    def test_gives_up_at_the_deadline(self):
+        network = FakeNetwork()
+        self.assertFalse(self.wait(network, 60))
+        self.assertEqual(network.now - 1000.0, 60)
+        # the last sleep is cut short to end at the deadline
+        self.assertTrue(all(seconds <= 30 for seconds in network.sleeps))
+        self.assertLess(network.probes, 12)
+
+    def test_zero_deadline_probes_once(self):
+        network = FakeNetwork()
+        self.assertFalse(self.wait(network, 0))
+        self.assertEqual(network.probes, 1)
+        self.assertEqual(network.sleeps, [])
+
+class ServerReachableTest(unittest.TestCase):
+
+    def test_any_answer_counts(self):
+        server = StandInServer({})
+        self.addCleanup(server.close)
+        self.assertTrue(updater.serverReachable(server.url + "/docksetups"))
+
+    def test_refused_connection_does_not(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        self.assertFalse(updater.serverReachable("http://127.0.0.1:%d" % port))
+
+    def test_file_url_needs_its_folder(self):
+        folder = tempDir(self)
+        self.assertTrue(updater.serverReachable("file://" + folder))
+        self.assertFalse(updater.serverReachable("file://" + folder + "/gone"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+'''
+--watch wakes for changes to the Dock plist and the config only, waits for
+a burst of them to settle and skips runs the fingerprint says are not needed
+'''
+import os
+import sys
+import threading
+import time
+import unittest
+
+from helpers import loadScript, tempDir
+
+agent = loadScript("dock-maintainer")
+
+def replace(thePath, contents):
+    '''replaces thePath by a rename, the way cfprefsd and the updater do'''
+    with open(thePath + ".tmp", "w") as newfile:
+        newfile.write(contents)
+    os.rename(thePath + ".tmp", thePath)
+
+def chatter(folder, seconds):
+    '''keeps rewriting another app's preferences in folder for seconds'''
+    def run():
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            replace(os.path.join(folder, "com.example.chatty.plist"), str(time.time()))
+            time.sleep(0.01)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+class WatcherTests(object):
+    '''tests every FileWatcher has to pass, mixed into a TestCase with makeWatcher'''
+
+    def setUp(self):
+        self.folder = tempDir(self)
+        self.dockplist = os.path.join(self.folder, "com.apple.dock.plist")
+        replace(self.dockplist, "dock")
+        self.watcher = self.makeWatcher([self.dockplist])
+
+    def test_times_out_without_changes(self):
+        start = time.time()
+        self.assertFalse(self.watcher.wait(0.2))
+        self.assertGreaterEqual(time.time() - start, 0.15)
+
+    def test_replaced_file_counts(self):
+        replace(self.dockplist, "changed dock")
+        self.assertTrue(self.watcher.wait(2))
+        self.assertFalse(self.watcher.wait(0.2))
+
+    def test_other_files_in_the_folder_do_not(self):
+        thread = chatter(self.folder, 0.4)
+        start = time.time()
+        self.assertFalse(self.watcher.wait(0.3))
+        self.assertLess(time.time() - start, 1.0)
+        thread.join()
+
+    def test_change_among_others_is_seen(self):
+        thread = chatter(self.folder, 0.5)
+        threading.Timer(0.2, replace, (self.dockplist, "changed dock")).start()
+        self.assertTrue(self.watcher.wait(2))
+        thread.join()
+
+class FakeKqueue(object):
+    '''a kqueue that reports an event for the folder every 10ms'''
+    def control(self, changes, maxevents, timeout=None):
+        if timeout is not None and timeout < 0.01:
+            time.sleep(timeout)
+            return []
+        time.sleep(0.01)
+        return [object()]
+
+class KqueueWatcherTest(WatcherTests, unittest.TestCase):
+    '''kqueue is not on Linux, so it is stood in for by one that fires
+        all the time, as it does next to busy preference files'''
+
+    def makeWatcher(self, paths):
+        watcher = agent.KqueueWatcher.__new__(agent.KqueueWatcher)
+        agent.FileWatcher.__init__(watcher, paths)
+        watcher._kqueue = FakeKqueue()
+        watcher._events = []
+        return watcher
+
+    def test_other_files_in_the_folder_do_not(self):
+        start = time.time()
+        self.assertFalse(self.watcher.wait(0.3))
+        self.assertLess(time.time() - start, 1.0)
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "inotify is Linux only")
+class InotifyWatcherTest(WatcherTests, unittest.TestCase):
+
+    def makeWatcher(self, paths):
+        return agent.InotifyWatcher(paths)
+
+class PollingWatcherTest(WatcherTests, unittest.TestCase):
+
+    def makeWatcher(self, paths):
+        return agent.PollingWatcher(paths, interval=0.02)
+
+    def test_change_in_place_counts(self):
+        with open(self.dockplist, "a") as dockfile:
+            dockfile.write(" and more")
+        self.assertTrue(self.watcher.wait(1))
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "inotify is Linux only")
+class DebounceTest(unittest.TestCase):
+
+    def test_burst_settles_once_quiet(self):
+        folder = tempDir(self)
+        dockplist = os.path.join(folder, "com.apple.dock.plist")
+        replace(dockplist, "dock")
+        watcher = agent.InotifyWatcher([dockplist])
+
+        def burst():
+            for index in range(10):
+                replace(dockplist, "dock %d" % index)
+                time.sleep(0.03)
+        thread = threading.Thread(target=burst)
+        thread.start()
+        self.assertTrue(watcher.wait(2))
+        start = time.time()
+        wakes = 0
+        while watcher.wait(0.2):
+            wakes += 1
+        thread.join()
+        self.assertGreater(wakes, 0)
+        self.assertLess(time.time() - start, 1.5)
+
+class Stop(Exception):
+    '''ends the watch loop'''
+
+class ScriptedWatcher(object):
+    '''returns the answers given in turn and records the timeouts asked for'''
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.timeouts = []
+
+    def wait(self, timeout=None):
+        self.timeouts.append(timeout)
+        if not self.answers:
+            raise Stop()
+        return self.answers.pop(0)
+
+class WatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reconciles = 0
+        self.fingerprints = [None, {"ReconcileSeconds": 0.1}, None]
+        backend = agent.MemoryBackend()
+        self.watcher = ScriptedWatcher([True, True, True, False, True, False])
+        self.patch("managedUser", lambda backend_: ("config", backend,
+                                                    agent.readKeys(backend)))
+        self.patch("makeWatcher", lambda paths: self.watcher)
+        self.patch("fingerprintMatches", lambda: self.fingerprints.pop(0))
+        self.patch("reconcile", self.reconcile)
+
+    def patch(self, name, value):
+        self.addCleanup(setattr, agent, name, getattr(agent, name))
+        setattr(agent, name, value)
+
+    def reconcile(self, *args):
+        self.reconciles += 1
+
+    def test_runs_are_debounced_and_skipped_when_the_fingerprint_matches(self):
+        with self.assertRaises(Stop):
+            agent.watch(debounce=2.0)
+        # reconciled at the start and after the second burst, the first
+        # left the fingerprint as it was
+        self.assertEqual(self.reconciles, 2)
+        self.assertEqual(self.watcher.timeouts, [None, 2.0, 2.0, 2.0, None, 2.0, None])
+
+if __name__ == '__main__':
+    unittest.main()